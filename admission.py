@@ -0,0 +1,171 @@
+import collections
+import json
+import message_codecs as mc
+from metrics import Histogram, queue_depth
+
+CRITICAL, NORMAL, BULK = 0, 1, 2
+LEVEL_NAMES = ('critical', 'normal', 'bulk')
+MALFORMED = 'malformed'     # Type name undecodable frames are admitted and counted as
+
+# Priority of inbound message types, the rest are NORMAL
+PRIORITIES = {
+    mc.MsgImpactReport.NAME: CRITICAL,
+    mc.MsgSetBlockStatus.NAME: CRITICAL,
+    mc.MsgLoginRequest.NAME: CRITICAL,
+    mc.MsgVehicleReport.NAME: BULK
+}
+
+"""
+TokenBucket(): Rate limit of one connection: rate frames per second, in bursts of up to burst frames.
+"""
+class TokenBucket():
+    __slots__ = ('rate', 'burst', 'tokens', 'last')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = now
+
+    def take(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+"""
+Admission(): Admission control of the frames going from the UserTerminal process to the manager queue (out_q).
+Decoded frames don't go to out_q right away: they wait in one backlog per priority level, and forward() moves
+them to out_q, critical first, only while out_q holds fewer than max_inflight items. Whatever is already in
+out_q is all a critical frame can find ahead of it, so its latency stays bounded however busy the rest is.
+
+Before a frame is decoded, admit() decides whether it gets in at all:
+- Every connection has a token bucket (rate frames per second, burst frames); frames over it are rate limited,
+  whatever their priority. Frames that can't be decoded take a token too, as MALFORMED (normal priority).
+- Once out_q and the backlogs hold watermark frames, bulk frames are shed; at max_depth, normal frames are too.
+Critical frames are never shed. Drops are counted per message type.
+Where the size of out_q can't be read (macOS), frames are forwarded as they come and only the rate limit applies.
+
+cfg is the 'admission' section of the configuration:
+    rate            Frames per second of every connection (default: no limit)
+    burst           Bucket size, in frames (default: rate)
+    watermark       Queued frames above which bulk frames are shed (default 1000)
+    max_depth       Queued frames above which normal frames are shed (default 5000)
+    max_inflight    Frames let into the manager queue at once (default 100)
+    priorities      Overrides of the priority of message types, {"<type name>": "critical"|"normal"|"bulk"}
+"""
+class Admission():
+    def __init__(self, cfg, out_q):
+        cfg = cfg or {}
+        self.out_q = out_q
+        self.rate = cfg.get('rate')
+        self.burst = cfg.get('burst', self.rate)
+        self.watermark = cfg.get('watermark', 1000)
+        self.max_depth = cfg.get('max_depth', 5000)
+        self.max_inflight = cfg.get('max_inflight', 100)
+        self.priorities = dict(PRIORITIES)
+        for name, level in cfg.get('priorities', {}).items():
+            self.priorities[name] = LEVEL_NAMES.index(level)
+        self.backlog = tuple(collections.deque() for _ in LEVEL_NAMES)
+        self.wait = tuple(Histogram() for _ in LEVEL_NAMES)    # Time spent in the backlog, microseconds
+        self.inflight = 0
+        self.rate_limited = {}
+        self.shed = {}
+
+    """
+    Returns a new token bucket for a connection, None without rate limit.
+    """
+    def bucket(self, now):
+        return TokenBucket(self.rate, self.burst, now) if self.rate else None
+
+    def depth(self):
+        return self.inflight + len(self.backlog[0]) + len(self.backlog[1]) + len(self.backlog[2])
+
+    """
+    Decides whether a frame of message type name, from the connection owning bucket, is let in. Returns its
+    priority level, or None if it's dropped.
+    """
+    def admit(self, name, bucket, now):
+        level = self.priorities.get(name, NORMAL)
+        if bucket is not None and not bucket.take(now):
+            self.rate_limited[name] = self.rate_limited.get(name, 0) + 1
+            return None
+        if level != CRITICAL and self.depth() >= (self.watermark if level == BULK else self.max_depth):
+            self.shed[name] = self.shed.get(name, 0) + 1
+            return None
+        return level
+
+    """
+    Takes a frame (pkt) received from the connection owning bucket, up to the point it's decoded. Returns
+    (level, msg, error):
+    - (level, msg, None) for a frame let in and decoded to msg.
+    - (level, None, error) for a frame that can't be decoded (not JSON, not a JSON object, not a valid message),
+      let in as MALFORMED unless it already was under its own type; error describes the problem.
+    - (None, None, error) for such a frame over the rate limit, (None, None, None) for any other frame dropped:
+      duplicates (link, a linkquality.LinkQuality), rate limited or shed.
+    log(value), if given, is called first with the JSON-decoded frame (None if it isn't JSON), for the frame log.
+    UserTerminal and replay.LocalTerminal both take their frames through here.
+    """
+    def receive(self, pkt, link, bucket, now, log=None):
+        try:
+            value = json.loads(pkt)
+        except ValueError as e:
+            value, error = None, e
+        else:
+            error = None
+        if log is not None:
+            log(value)
+        level = None
+        if error is None:
+            try:
+                if not isinstance(value, dict):
+                    raise TypeError(f"Frame is a JSON {type(value).__name__}, not an object")
+                # Repeated vehicle reports are dropped here, before building the message
+                if not link.accept(value):
+                    return None, None, None
+                # Frames over the rate limit of the connection, or shed under load, are dropped before decoding
+                level = self.admit(value.get('type'), bucket, now)
+                if level is None:
+                    return None, None, None
+                return level, mc.parse_dict(value), None
+            except (ValueError, TypeError, KeyError) as e:
+                error = e
+        error = f"Message key {error} missing" if isinstance(error, KeyError) else str(error)
+        # Undecodable frames are charged to the connection like any other, unless already admitted
+        if level is None:
+            level = self.admit(MALFORMED, bucket, now)
+        return level, None, error
+
+    """
+    Queues an item for the manager at a priority level. now is the time it's queued at, in seconds.
+    """
+    def put(self, level, item, now):
+        self.backlog[level].append((now, item))
+
+    """
+    Moves queued items to out_q, highest priority first, up to max_inflight items in out_q. Returns the number of
+    items moved.
+    """
+    def forward(self, now):
+        inflight = queue_depth(self.out_q)
+        room = self.max_inflight - inflight if inflight is not None else float('inf')
+        moved = 0
+        for backlog, wait in zip(self.backlog, self.wait):
+            while backlog and moved < room:
+                t, item = backlog.popleft()
+                self.out_q.put(item)
+                wait.record((now - t) * 1e6)
+                moved += 1
+        self.inflight = (inflight or 0) + moved
+        return moved
+
+    def stats(self):
+        return {
+            'inflight': self.inflight,
+            'backlog': {name: len(backlog) for name, backlog in zip(LEVEL_NAMES, self.backlog)},
+            'wait_us': {name: wait.as_dict() for name, wait in zip(LEVEL_NAMES, self.wait)},
+            'rate_limited': dict(self.rate_limited),
+            'shed': dict(self.shed)
+        }
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+import checklist_eval
+from checklist_eval import ChecklistMasks
+
+LOGIN = 'login'
+CHECKLIST_VERSION = 'checklist_version'
+CHECKLIST_RESPONSES = 'checklist_responses'
+QUESTION_RESPONSE = 'question_response'
+BLOCK_STATUS = 'block_status'
+
+# tagids are unsigned 64-bit, SQLite integers are signed
+def to_db_id(value):
+    return value - (1 << 64) if value is not None and value >= 1 << 63 else value
+
+def from_db_id(value):
+    return value + (1 << 64) if value is not None and value < 0 else value
+
+"""
+AuditStore(): Write-behind audit trail in SQLite.
+record() only puts the record in a bounded in-memory queue, so callers never wait on disk. A background thread
+takes records from the queue and writes them in batches, one transaction per batch: a batch is written when it
+reaches batch_size records or when flush_interval seconds have passed since its first record. If the queue is
+full (the disk can't keep up), new records are dropped and counted in dropped. A batch that fails to be written
+(disk full, database locked) is logged and counted in failed, and the thread goes on with the next one.
+The table is indexed by tagid, uid and time, for the queries in query().
+"""
+class AuditStore():
+    QUEUE_SIZE = 10000
+    BATCH_SIZE = 500
+    FLUSH_INTERVAL = 1.0
+
+    def __init__(self, filename=':memory:', queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # Shared by the writer thread and query(), always used with self._lock held
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._lock = threading.Lock()
+        if filename != ':memory:':
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS audit (id INTEGER PRIMARY KEY, ts REAL NOT NULL, kind TEXT NOT NULL, tagid INTEGER, uid INTEGER, data TEXT)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS audit_tagid ON audit (tagid, ts)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS audit_uid ON audit (uid, ts)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS audit_ts ON audit (ts)")
+        self._queue = queue.Queue(queue_size)
+        self.dropped = 0
+        self.failed = 0
+        self.written = 0
+        self.batches = 0
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    """
+    Builds the store from the 'audit' configuration section ({"file", "queue_size", "batch_size",
+    "flush_interval"}). Returns None without it.
+    """
+    @classmethod
+    def from_config(cls, cfg_audit):
+        if not cfg_audit:
+            return None
+        return cls(cfg_audit.get('file', ':memory:'), cfg_audit.get('queue_size', cls.QUEUE_SIZE),
+            cfg_audit.get('batch_size', cls.BATCH_SIZE), cfg_audit.get('flush_interval', cls.FLUSH_INTERVAL))
+
+    """
+    Queues a record. data is a JSON-serializable dictionary with the details. Never blocks.
+    """
+    def record(self, kind, tagid, uid, data, ts=None):
+        try:
+            self._queue.put_nowait((time.time() if ts is None else ts, kind, to_db_id(tagid), uid, json.dumps(data)))
+        except queue.Full:
+            self.dropped += 1
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            batch = [item]
+            stop = False
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            try:
+                with self._lock:
+                    with self._db:
+                        self._db.executemany("INSERT INTO audit (ts, kind, tagid, uid, data) VALUES (?, ?, ?, ?, ?)", batch)
+            except sqlite3.Error as e:
+                self.failed += len(batch)
+                logging.getLogger().error(f"Audit batch of {len(batch)} records not written: {e}")
+            else:
+                self.written += len(batch)
+                self.batches += 1
+            for _ in range(len(batch) + stop):
+                self._queue.task_done()
+            if stop:
+                return
+
+    """
+    Waits until every record queued so far is written.
+    """
+    def flush(self):
+        self._queue.join()
+
+    """
+    Returns the records matching every given condition (tagid, uid, kind, t0 <= ts < t1), newest first, as
+    dictionaries.
+    """
+    def query(self, tagid=None, uid=None, t0=None, t1=None, kind=None, limit=100):
+        conditions = []
+        params = []
+        for column, op, value in (('tagid', '=', to_db_id(tagid)), ('uid', '=', uid), ('ts', '>=', t0), ('ts', '<', t1), ('kind', '=', kind)):
+            if value is not None:
+                conditions.append(f"{column} {op} ?")
+                params.append(value)
+        sql = "SELECT ts, kind, tagid, uid, data FROM audit"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY ts DESC LIMIT ?"
+        with self._lock:
+            rows = self._db.execute(sql, params + [limit]).fetchall()
+        return [{'ts': ts, 'kind': kind, 'tagid': from_db_id(tagid), 'uid': uid, 'data': json.loads(data)} for ts, kind, tagid, uid, data in rows]
+
+    """
+    Returns every record of the given kinds with t0 <= ts < t1, oldest first, as (ts, kind, tagid, uid, data).
+    """
+    def scan(self, kinds, t0=None, t1=None):
+        sql = f"SELECT ts, kind, tagid, uid, data FROM audit WHERE kind IN ({', '.join('?' * len(kinds))})"
+        params = list(kinds)
+        for op, value in (('>=', t0), ('<', t1)):
+            if value is not None:
+                sql += f" AND ts {op} ?"
+                params.append(value)
+        with self._lock:
+            rows = self._db.execute(sql + " ORDER BY ts, id", params).fetchall()
+        return [(ts, kind, from_db_id(tagid), uid, json.loads(data)) for ts, kind, tagid, uid, data in rows]
+
+    def stats(self):
+        return {
+            'queued': self._queue.qsize(),
+            'written': self.written,
+            'batches': self.batches,
+            'dropped': self.dropped,
+            'failed': self.failed
+        }
+
+    """
+    Writes the records still queued and closes the database. Waits at most timeout seconds for the writer; if it
+    doesn't finish, the records left are lost and the database is left for the process exit to close.
+    """
+    def close(self, timeout=5.0):
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            logging.getLogger().error(f"Audit store not closed, {self._queue.qsize()} records not written")
+            return
+        self._writer.join(timeout)
+        if self._writer.is_alive():
+            logging.getLogger().error(f"Audit store not closed, {self._queue.qsize()} records not written")
+            return
+        self._db.close()
+
+"""
+Evaluates the checklist responses recorded with t0 <= ts < t1 in bulk (see checklist_eval.evaluate_batch()), against
+the masks recorded along with every checklist version. Wire versions wrap around, so responses are evaluated with
+the latest version of their number recorded before them.
+"""
+def evaluate_checklists(store, t0=None, t1=None, block_unanswered=False):
+    masks_by_version = {}
+
+    def responses():
+        for ts, kind, tagid, uid, data in store.scan((CHECKLIST_VERSION, CHECKLIST_RESPONSES), None, t1):
+            if kind == CHECKLIST_VERSION:
+                masks_by_version[data['checklist_version']] = ChecklistMasks.from_dict(data['masks'])
+            elif t0 is None or ts >= t0:
+                yield data['checklist_version'], data['yes_mask'], data['answered_mask']
+
+    return checklist_eval.evaluate_batch(responses(), masks_by_version, block_unanswered)
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description="Query an audit database")
+    p.add_argument('database')
+    p.add_argument('--tagid', type=int)
+    p.add_argument('--uid', type=int)
+    p.add_argument('--kind', choices=[LOGIN, CHECKLIST_VERSION, CHECKLIST_RESPONSES, QUESTION_RESPONSE, BLOCK_STATUS])
+    p.add_argument('--start', type=float, help="Start timestamp (UNIX time)")
+    p.add_argument('--end', type=float, help="End timestamp (UNIX time)")
+    p.add_argument('--limit', type=int, default=100)
+    p.add_argument('--evaluate', action='store_true', help="Summarize the evaluation of the checklist responses in the time range instead")
+    p.add_argument('--block-unanswered', action='store_true', help="With --evaluate, count unanswered critical questions as failed")
+    args = p.parse_args()
+
+    store = AuditStore(args.database)
+    if args.evaluate:
+        print(json.dumps(evaluate_checklists(store, args.start, args.end, args.block_unanswered), indent=2))
+    else:
+        for record in store.query(args.tagid, args.uid, args.start, args.end, args.kind, args.limit):
+            print(json.dumps(record))
+    store.close()
@@ -0,0 +1,107 @@
+import field_codecs as fc
+
+"""
+Checklist response evaluation.
+Answers come from the terminal as {question_position: answer} with answer codes ANSWER_NO, ANSWER_YES and
+ANSWER_NA. Each checklist version gets its expected answers and critical questions precomputed as bitmasks (bit i
+is question position i), so evaluating a set of responses takes a handful of integer operations.
+"""
+ANSWER_NO = fc.ANSWER_NO
+ANSWER_YES = fc.ANSWER_YES
+ANSWER_NA = fc.ANSWER_NA
+
+"""
+ChecklistMasks(): Precomputed masks of one checklist. as_dict() and from_dict() give the form kept in the audit trail.
+"""
+class ChecklistMasks():
+    __slots__ = ('full', 'expected', 'critical')
+
+    def __init__(self, checklist_data):
+        self.full = (1 << len(checklist_data)) - 1
+        self.expected = 0
+        self.critical = 0
+        for i, q in enumerate(checklist_data):
+            if q['expected']:
+                self.expected |= 1 << i
+            if q['critical']:
+                self.critical |= 1 << i
+
+    def as_dict(self):
+        return {'full': self.full, 'expected': self.expected, 'critical': self.critical}
+
+    @classmethod
+    def from_dict(cls, value):
+        masks = cls.__new__(cls)
+        masks.full = value['full']
+        masks.expected = value['expected']
+        masks.critical = value['critical']
+        return masks
+
+"""
+EvalResult(): Outcome of evaluating one set of responses.
+mismatched has a bit set for every answered question whose answer isn't the expected one, critical_failed for
+every critical question answered wrong, and also left unanswered (not applicable counts as unanswered) when
+evaluated with block_unanswered.
+"""
+class EvalResult():
+    __slots__ = ('mismatched', 'critical_failed')
+
+    def __init__(self, mismatched, critical_failed):
+        self.mismatched = mismatched
+        self.critical_failed = critical_failed
+
+    @property
+    def blocked(self):
+        return self.critical_failed != 0
+
+    def as_dict(self):
+        return {
+            'mismatched': [i for i in range(self.mismatched.bit_length()) if self.mismatched >> i & 1],
+            'critical_failed': [i for i in range(self.critical_failed.bit_length()) if self.critical_failed >> i & 1],
+            'blocked': self.blocked
+        }
+
+"""
+Evaluates a set of responses against masks. Critical questions fail on a wrong answer; with block_unanswered, on a
+missing or not applicable one too.
+"""
+def evaluate(masks, yes, answered, block_unanswered=False):
+    answered &= masks.full
+    mismatched = (yes ^ masks.expected) & answered
+    failed = mismatched | (masks.full & ~answered) if block_unanswered else mismatched
+    return EvalResult(mismatched, masks.critical & failed)
+
+"""
+Evaluates stored responses in bulk, for audit reports (see audit.evaluate_checklists()).
+records is an iterable of (checklist_version, yes_mask, answered_mask) and masks_by_version maps checklist versions
+to their ChecklistMasks, looked up as each record comes. Returns a summary dictionary; records for unknown versions are counted apart.
+block_unanswered is as in evaluate().
+"""
+def evaluate_batch(records, masks_by_version, block_unanswered=False):
+    total = passed = blocked = unknown = 0
+    mismatches_per_position = {}
+    for version, yes, answered in records:
+        masks = masks_by_version.get(version)
+        if masks is None:
+            unknown += 1
+            continue
+        total += 1
+        answered &= masks.full
+        mismatched = (yes ^ masks.expected) & answered
+        failed = mismatched | (masks.full & ~answered) if block_unanswered else mismatched
+        if masks.critical & failed:
+            blocked += 1
+        elif not mismatched:
+            passed += 1
+        while mismatched:
+            low = mismatched & -mismatched
+            position = low.bit_length() - 1
+            mismatches_per_position[position] = mismatches_per_position.get(position, 0) + 1
+            mismatched ^= low
+    return {
+        'evaluated': total,
+        'passed': passed,
+        'blocked': blocked,
+        'unknown_version': unknown,
+        'mismatches_per_position': mismatches_per_position
+    }
@@ -0,0 +1,104 @@
+from array import array
+import json
+import message_codecs as mc
+from checklist_eval import ChecklistMasks
+
+"""
+ChecklistVersion(): One version of the checklist.
+questions is the question set it was picked from (shared by all versions created with the same configuration),
+picked holds the indices of the picked questions, in checklist order, as a compact array of 16-bit ints.
+wire_version is the 8-bit version number sent to the terminals.
+The encoded forms of the checklist are built once, when the version is created, and dropped along with it:
+update_json is the MsgChecklistUpdate as sent through the terminal link, and segments the MsgChecklistUpdateStart
+and MsgChecklistUpdateSegment frames for segmented transfers (compressed if a zdict is given), as (message type
+name, JSON payload) pairs ready for the link.
+Delta updates from older versions are encoded on first use and cached in deltas, keyed by base version.
+masks holds the expected answer and critical question bitmasks used to evaluate responses.
+"""
+class ChecklistVersion():
+    __slots__ = ('seq', 'wire_version', 'questions', 'picked', 'update_json', 'segments', 'deltas', 'masks')
+
+    def __init__(self, seq, wire_version, questions, picked, zdict=None):
+        self.seq = seq
+        self.wire_version = wire_version
+        self.questions = questions
+        self.picked = array('H', picked)
+
+        checklist_data = self.checklist_data()
+        msg = mc.MsgChecklistUpdate({'checklist_version': wire_version, 'checklist_data': checklist_data})
+        self.update_json = msg.as_json().encode()
+        self.segments = tuple((m.NAME, m.as_json().encode()) for m in mc.checklist_splitter(checklist_data, wire_version, zdict))
+        self.deltas = {}
+        self.masks = ChecklistMasks(checklist_data)
+
+    def checklist_data(self):
+        return [self.questions[i] for i in self.picked]
+
+    """
+    Returns the encoded MsgChecklistDelta (JSON) that updates a terminal holding base to this version, or None if
+    the delta isn't smaller than the full update. Questions are matched by content, so deltas also work across
+    configuration reloads.
+    """
+    def delta_from(self, base):
+        try:
+            return self.deltas[base.seq]
+        except KeyError:
+            pass
+
+        base_positions = {json.dumps(q, sort_keys=True): i for i, q in enumerate(base.checklist_data())}
+        delta = [base_positions.get(json.dumps(q, sort_keys=True), q) for q in self.checklist_data()]
+        payload = mc.MsgChecklistDelta({'checklist_version': self.wire_version, 'base_version': base.wire_version, 'delta': delta}).as_json().encode()
+        if len(payload) >= len(self.update_json):
+            payload = None
+        self.deltas[base.seq] = payload
+        return payload
+
+"""
+ChecklistStore(): Fixed-capacity history of the most recent checklist versions.
+Versions go through the wire as a single byte. Wire version 0 is never used (a terminal reports 0 when it has no
+checklist), so versions run 1..255 and then wrap around to 1. Versions are kept in a 256-slot table indexed by
+wire version, so looking up the version a terminal answered is O(1). When a new version is added, the one that
+falls out of the history window is dropped, which keeps memory constant no matter how long the process runs.
+"""
+class ChecklistStore():
+    CAPACITY = 32
+    WIRE_VERSIONS = 255
+
+    def __init__(self, capacity=CAPACITY):
+        if not 0 < capacity < self.WIRE_VERSIONS:
+            raise ValueError(f"Checklist history capacity must be between 1 and {self.WIRE_VERSIONS - 1}")
+        self.capacity = capacity
+        self._slots = [None] * (self.WIRE_VERSIONS + 1)
+        self._seq = 0
+
+    @classmethod
+    def wire(cls, seq):
+        return (seq - 1) % cls.WIRE_VERSIONS + 1
+
+    def add(self, questions, picked, zdict=None):
+        self._seq += 1
+        if self._seq > self.capacity:
+            self._slots[self.wire(self._seq - self.capacity)] = None
+        version = ChecklistVersion(self._seq, self.wire(self._seq), questions, picked, zdict)
+        self._slots[version.wire_version] = version
+        return version
+
+    @property
+    def current(self):
+        if self._seq == 0:
+            return None
+        return self._slots[self.wire(self._seq)]
+
+    def get(self, wire_version):
+        # Returns the version with that wire number, or None if it's unknown or was dropped from the history
+        if not 0 < wire_version <= self.WIRE_VERSIONS:
+            return None
+        return self._slots[wire_version]
+
+    def __len__(self):
+        return min(self._seq, self.capacity)
+
+    def __iter__(self):
+        # Oldest to newest
+        for seq in range(max(1, self._seq - self.capacity + 1), self._seq + 1):
+            yield self._slots[self.wire(seq)]
@@ -0,0 +1,122 @@
+import heapq
+import itertools
+import time
+
+"""
+Clocks. Everything that reads the time, sleeps or schedules work goes through a clock object, so a run can use
+real time (WallClock) or simulated time (VirtualClock).
+Both clocks keep a heap of timers set with call_later()/call_at() (monotonic deadlines). Timers run from the
+owner's loop, when it calls run_due() or wait(); they never run from another thread.
+"""
+
+"""
+Timer(): Handle of a scheduled call, returned by call_later() and call_at().
+"""
+class Timer():
+    __slots__ = ('deadline', 'fn', 'args', 'cancelled')
+
+    def __init__(self, deadline, fn, args):
+        self.deadline = deadline
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class _Clock():
+    def __init__(self):
+        self._timers = []
+        self._seq = itertools.count()   # Tie breaker, timers with the same deadline run in scheduling order
+
+    def call_at(self, deadline, fn, *args):
+        timer = Timer(deadline, fn, args)
+        heapq.heappush(self._timers, (deadline, next(self._seq), timer))
+        return timer
+
+    def call_later(self, delay, fn, *args):
+        return self.call_at(self.monotonic() + delay, fn, *args)
+
+    def next_deadline(self):
+        while self._timers and self._timers[0][2].cancelled:
+            heapq.heappop(self._timers)
+        return self._timers[0][0] if self._timers else None
+
+    """
+    Runs the timers whose deadline has passed. Returns the number of timers run.
+    """
+    def run_due(self):
+        count = 0
+        now = self.monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            timer = heapq.heappop(self._timers)[2]
+            if not timer.cancelled:
+                timer.fn(*timer.args)
+                count += 1
+        return count
+
+"""
+WallClock(): Real time, from the time module.
+"""
+class WallClock(_Clock):
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    """
+    Idle wait of the main loop: sleeps up to timeout seconds, less if a timer is due before, and runs due timers.
+    """
+    def wait(self, timeout):
+        deadline = self.next_deadline()
+        if deadline is not None:
+            timeout = min(timeout, max(0, deadline - time.monotonic()))
+        time.sleep(timeout)
+        self.run_due()
+
+"""
+VirtualClock(): Simulated time, only moved by sleep(), wait() and advance_to().
+Idle waits jump straight to the next timer, so simulated hours take as long as the work done in them, and runs
+with the same inputs give the same results. start is the UNIX time returned by time() at monotonic time zero.
+"""
+class VirtualClock(_Clock):
+    def __init__(self, start=0.0):
+        super().__init__()
+        self.start = start
+        self.now = 0.0
+
+    def time(self):
+        return self.start + self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    """
+    Moves the clock to the monotonic time t, running the timers due on the way at their own deadlines.
+    """
+    def advance_to(self, t):
+        while True:
+            deadline = self.next_deadline()
+            if deadline is None or deadline > t:
+                break
+            self.now = max(self.now, deadline)
+            self.run_due()
+        self.now = max(self.now, t)
+
+    """
+    Idle wait of the main loop: jumps to the next timer and runs it. With no timers, the clock moves timeout seconds.
+    """
+    def wait(self, timeout):
+        deadline = self.next_deadline()
+        if deadline is None:
+            self.now += timeout
+        else:
+            self.now = max(self.now, deadline)
+            self.run_due()
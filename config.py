@@ -0,0 +1,115 @@
+import json
+import os
+import queue
+import threading
+import field_codecs as fc
+from userstore import UserStore
+import compression
+from question_bank import QuestionBank
+from geofence import Geofence
+
+"""
+RuntimeConfig(): Parsed and validated configuration, along with the structures derived from it.
+Everything the message handlers need from the configuration is built here, so a new configuration can be
+prepared off the hot path and swapped in with a single assignment.
+"""
+class RuntimeConfig():
+    def __init__(self, cfg):
+        validate(cfg)
+        self.cfg = cfg
+        self.users = UserStore.from_config(cfg)
+        self.bank = QuestionBank.from_config(cfg)
+        self.questions = self.bank.questions
+        self.num_questions = cfg['checklist_num_questions']
+        self.vehicle_type = cfg.get('vehicle_type', '*')
+        self.categories = cfg.get('checklist_categories')
+        if self.num_questions > len(self.bank):
+            raise ValueError("checklist_num_questions larger than the question bank")
+        # Preset dictionary for compressed segment transfers
+        self.zdict = compression.build_zdict(self.questions) if cfg.get('checklist_compression', False) else None
+        # Zones with their grid indexes, None without a 'geofence' section
+        self.geofence = Geofence.from_config(cfg.get('geofence'))
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as cfgh:
+            return cls(json.load(cfgh))
+
+    def close(self):
+        self.users.close()
+
+"""
+Checks the parts of the configuration that can change at runtime. Raises ValueError describing the first problem found.
+"""
+def validate(cfg):
+    for key in ('bluetooth', 'tagid', 'checklist_num_questions'):
+        if key not in cfg:
+            raise ValueError(f"Configuration key '{key}' missing")
+    if 'checklist_questions' not in cfg and 'question_bank' not in cfg:
+        raise ValueError("Configuration needs either 'checklist_questions' or 'question_bank'")
+    if 'userdb' not in cfg and 'userdb_file' not in cfg:
+        raise ValueError("Configuration needs either 'userdb' or 'userdb_file'")
+    for uid, userinfo in cfg.get('userdb', {}).items():
+        if not uid.isdigit() or 'username' not in userinfo or 'profile' not in userinfo:
+            raise ValueError(f"Invalid userdb entry {uid}")
+    for i, question in enumerate(cfg.get('checklist_questions', [])):
+        if not all(k in question for k in ('question', 'expected', 'critical')):
+            raise ValueError(f"Invalid checklist question {i}")
+    if not 0 < cfg['checklist_num_questions'] <= len(cfg.get('checklist_questions', [])) and 'question_bank' not in cfg:
+        raise ValueError("checklist_num_questions out of range")
+    if cfg['checklist_num_questions'] > fc.FieldChecklistResponses.NUM_RESPONSES:
+        raise ValueError(f"checklist_num_questions larger than the {fc.FieldChecklistResponses.NUM_RESPONSES} responses a terminal can send")
+
+"""
+ConfigWatcher(): Background thread that reloads the configuration file.
+The file is checked every poll_interval seconds (by modification time) and reloaded when it changes, or right
+away when reload() is called. The SQLite user database of the configuration ('userdb_file', cfg being the one
+loaded) is watched too, so changes to it drop the cached login responses. Loading and building the derived structures happens in this thread; ready
+RuntimeConfig objects are left in self.updates for the main loop to swap in. Invalid configurations are reported
+in self.errors and the running one is kept.
+"""
+class ConfigWatcher(threading.Thread):
+    def __init__(self, filename, poll_interval=1.0, cfg=None):
+        super().__init__(daemon=True)
+        self.filename = filename
+        self.poll_interval = poll_interval
+        self.updates = queue.Queue()
+        self.errors = queue.Queue()
+        self._reload = threading.Event()
+        self._watch(cfg or {})
+        self._mtime = self._get_mtime()
+
+    def _watch(self, cfg):
+        self._files = [self.filename]
+        if 'userdb_file' in cfg:
+            # Committed changes may sit in the write-ahead log until a checkpoint
+            self._files += [cfg['userdb_file'], cfg['userdb_file'] + '-wal']
+
+    def _get_mtime(self):
+        mtimes = []
+        for filename in self._files:
+            try:
+                mtimes.append(os.stat(filename).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+        return tuple(mtimes)
+
+    def reload(self):
+        self._reload.set()
+
+    def run(self):
+        while True:
+            forced = self._reload.wait(self.poll_interval)
+            self._reload.clear()
+            mtime = self._get_mtime()
+            if not forced and mtime == self._mtime:
+                continue
+            self._mtime = mtime
+            try:
+                rt = RuntimeConfig.load(self.filename)
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                self.errors.put(f"{self.filename}: {e}")
+            else:
+                self._watch(rt.cfg)
+                self._mtime = self._get_mtime()
+                self.updates.put(rt)
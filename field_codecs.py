@@ -4,6 +4,20 @@ import json
 
 ENDIANNESS = 'little'
 
+# Checklist answer codes
+ANSWER_NO = 0
+ANSWER_YES = 1
+ANSWER_NA = 2
+
+# Lookup tables for packed checklist responses: [ answer(3 MSB) | question_id(5 LSB) ]
+RESPONSE_QUESTION_ID = bytes(x & 0x1f for x in range(256))
+RESPONSE_ANSWER = bytes(x >> 5 for x in range(256))
+RESPONSE_YES_BIT = tuple(1 << (x & 0x1f) if x >> 5 == ANSWER_YES else 0 for x in range(256))
+RESPONSE_ANSWERED_BIT = tuple(1 << (x & 0x1f) if x >> 5 in (ANSWER_NO, ANSWER_YES) else 0 for x in range(256))
+
+# Lookup table for bit-packed bool lists: byte -> its 8 bits as bools, LSB first
+BYTE_TO_BOOLS = tuple(tuple(bool(x >> i & 1) for i in range(8)) for x in range(256))
+
 """
 FieldInteger(): Generic class from which all signed integer types derive.
 """
@@ -143,6 +157,11 @@ class FieldJSON():
     def as_bytes(self):
         return ((json.dumps(self._value) + '\0' * self._length)[0:self._length]).encode()
 
+"""
+FieldVarLenList(): Variable length list of bools, stored as a bitset.
+raw = [ count(1) | bits(length - 1) ], bit i of the little endian bitset is element i.
+The bitset is also available as an int through the mask property.
+"""
 class FieldVarLenList():
     def __init__(self, value, length):
         self._length = length
@@ -150,29 +169,47 @@ class FieldVarLenList():
 
     @property
     def value(self):
-        return self._value
+        out = []
+        for b in self._bits.to_bytes(self._length - 1, ENDIANNESS)[:(self._count + 7) // 8]:
+            out.extend(BYTE_TO_BOOLS[b])
+        return out[:self._count]
 
     @value.setter
     def value(self, value):
         if isinstance(value, bytes):
-            if len(value) != self._length:
+            if len(value) != self._length or value[0] > (self._length - 1) * 8:
                 raise ValueError
-            self._value = [bool(x) for x in value[1:value[0] + 1]]
+            self._count = value[0]
+            self._bits = int.from_bytes(value[1:], ENDIANNESS) & ((1 << self._count) - 1)
 
         elif isinstance(value, list):
-            if len(value) > self._length - 1:
+            if len(value) > (self._length - 1) * 8:
                 raise ValueError(value)
-            self._value = value
+            self._count = len(value)
+            self._bits = 0
+            for i, x in enumerate(value):
+                if x:
+                    self._bits |= 1 << i
+
+        else:
+            raise ValueError
+
+    @property
+    def mask(self):
+        return self._bits
+
+    def __len__(self):
+        return self._count
 
     def as_bytes(self):
-        out = bytes([len(self._value)])
-        out += bytes(self._value)
-        out += bytes(20)
-        out = out[:self._length]
-        return out
+        return bytes([self._count]) + self._bits.to_bytes(self._length - 1, ENDIANNESS)
 
 """
 FieldChecklistResponses()
+raw = one byte per response: [ answer(3 MSB) | question_id(5 LSB) ]
+Responses are kept packed and decoded through the RESPONSE_* lookup tables. Besides the {question_id: answer}
+dictionary, they're available as bitmasks (bit i is question i): yes_mask for questions answered yes, and
+answered_mask for questions answered yes or no (not N/A).
 """
 class FieldChecklistResponses():
     NUM_RESPONSES = 5   # 0 < NUM_RESPONSES < 26 (taking packet size of 34 bytes)
@@ -181,30 +218,40 @@ class FieldChecklistResponses():
     def __init__(self, value):
         # This length checking works both for dictionaries and byte strings
         if len(value) != self.NUM_RESPONSES:
-            raise ValueError("Message has an incorrect {} number of responses".format(len(value['responses'])))
+            raise ValueError(f"Message has an incorrect number of responses ({len(value)})")
         if isinstance(value, dict):
-            self._value = {}
+            packed = bytearray()
             for k, v in value.items():
-                if v not in (0, 1, 2):
+                k = int(k)
+                if v not in (ANSWER_NO, ANSWER_YES, ANSWER_NA) or not 0 <= k < 32:
                     raise ValueError
-                self._value[int(k)] = v
+                packed.append(v << 5 | k)
+            self._raw = bytes(packed)
         elif isinstance(value, bytes):
-            for x in value:
-                k = x & 0x1f    # The 5 LSB bytes are the question_id
-                v = x >> 5 & 0x7    # The 3 MSB bits are the answer value
-                self._value[k] = v
+            self._raw = value
         else:
             raise ValueError
 
     @property
     def value(self):
-        return self._value
+        return {RESPONSE_QUESTION_ID[x]: RESPONSE_ANSWER[x] for x in self._raw}
+
+    @property
+    def yes_mask(self):
+        mask = 0
+        for x in self._raw:
+            mask |= RESPONSE_YES_BIT[x]
+        return mask
+
+    @property
+    def answered_mask(self):
+        mask = 0
+        for x in self._raw:
+            mask |= RESPONSE_ANSWERED_BIT[x]
+        return mask
 
     def as_bytes(self):
-        out = bytes(self.NUM_RESPONSES)
-        for k, v in self._value.items():
-            out += v << 5 | k
-        return out
+        return self._raw
 
 """
 FieldUID(): Class for parsing and retrieval of 32-bit UIDs.
@@ -269,6 +316,18 @@ class FieldChecklistData(FieldJSON):
     def __init__(self, value):
         super().__init__(value, self.SIZE)
 
+"""
+FieldChecklistDelta(): Class for storing checklist delta updates.
+value is a list with one entry per question of the new checklist: an int is the index of a question kept from
+the base checklist, a dict is a question added in the new version. Questions of the base checklist not
+referenced are the removed ones.
+"""
+class FieldChecklistDelta(FieldJSON):
+    SIZE = 4096
+
+    def __init__(self, value):
+        super().__init__(value, self.SIZE)
+
 """
 FieldChecklistSegment(): Class for storing checklist update data segments.
 """
@@ -318,9 +377,9 @@ class FieldUWBPosition():
             raise ValueError
 
     def as_bytes(self):
-        out = (self._xpos * self.CONV_FACTOR).to_bytes(self.BYTES_PER_DIM, ENDIANNESS, signed=True)
-        out += (self._ypos * self.CONV_FACTOR).to_bytes(self.BYTES_PER_DIM, ENDIANNESS, signed=True)
-        out += (self._zpos * self.CONV_FACTOR).to_bytes(self.BYTES_PER_DIM, ENDIANNESS, signed=True)
+        out = round(self._xpos * self.CONV_FACTOR).to_bytes(self.BYTES_PER_DIM, ENDIANNESS, signed=True)
+        out += round(self._ypos * self.CONV_FACTOR).to_bytes(self.BYTES_PER_DIM, ENDIANNESS, signed=True)
+        out += round(self._zpos * self.CONV_FACTOR).to_bytes(self.BYTES_PER_DIM, ENDIANNESS, signed=True)
         return out
 
 """
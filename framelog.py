@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+import argparse
+import bisect
+import mmap
+import os
+import struct
+import message_codecs as mc
+from clock import WallClock
+
+DIR_IN = 0      # Frame received from the terminal
+DIR_OUT = 1     # Frame sent to the terminal
+
+MAGIC = b'TDFL\x02\0\0\0'
+MAGIC_V1 = b'TDFL\x01\0\0\0'                 # Segments without connection ids, still readable
+RECORD_HEADER = struct.Struct('<IdQBBI')    # payload length, timestamp, tagid, message type, direction, connection
+RECORD_HEADER_V1 = struct.Struct('<IdQBB')
+INDEX_ENTRY = struct.Struct('<dQQ')         # block start timestamp, tagid, block start offset
+
+"""
+FrameLog(): Append-only log of raw frames in preallocated, memory-mapped segment files.
+Each segment is a file of segment_size bytes, mapped in memory and filled sequentially:
+    [ magic(8) | record | record | ... | zeros ]
+    record = [ length(4) | timestamp(8) | tagid(8) | msgtype(1) | direction(1) | conn(4) | payload(length) ]
+conn is the id of the terminal connection the frame came from or went to (frames sent to every terminal are
+logged once per connection).
+A zero length marks the end of the used part. When a frame doesn't fit, the segment is trimmed to its used
+size and a new one is started. If max_segments is set, the oldest segments are deleted.
+
+Next to every segment there's a sparse index (.idx). Records are grouped in blocks of BLOCK_RECORDS, and every
+block gets one index entry per tagid present in it: (timestamp of the first record of the block, tagid, offset
+of the block). Readers use it to skip to the right time and to skip blocks not containing a tag.
+
+Inbound frames are always logged. With capture set, frames sent to the terminal are logged too (direction
+DIR_OUT), so the log holds the whole conversation and can be replayed (see replay.py).
+Frames are timestamped with clock (see clock.py, WallClock by default) unless append() is given one, so runs on a
+VirtualClock log simulated times.
+"""
+class FrameLog():
+    SEGMENT_SIZE = 64 * 1024 * 1024
+    BLOCK_RECORDS = 256
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE, max_segments=None, capture=False, clock=None):
+        self.directory = directory
+        self.clock = clock or WallClock()
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.capture = capture
+        os.makedirs(directory, exist_ok=True)
+        segments = list_segments(directory)
+        self._seq = int(os.path.basename(segments[-1])[len('frames-'):-len('.log')]) if segments else 0
+        self._map = None
+        self._open_segment()
+
+    @classmethod
+    def from_config(cls, cfg_framelog, clock=None):
+        if not cfg_framelog or 'directory' not in cfg_framelog:
+            return None
+        return cls(cfg_framelog['directory'], cfg_framelog.get('segment_size', cls.SEGMENT_SIZE), cfg_framelog.get('max_segments'),
+            cfg_framelog.get('capture', False), clock)
+
+    def _open_segment(self):
+        self._seq += 1
+        self._filename = os.path.join(self.directory, f"frames-{self._seq:08d}.log")
+        self._fd = os.open(self._filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.ftruncate(self._fd, self.segment_size)
+        self._map = mmap.mmap(self._fd, self.segment_size)
+        self._map[0:len(MAGIC)] = MAGIC
+        self._pos = len(MAGIC)
+        self._idx_fd = os.open(self._filename[:-len('.log')] + '.idx', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        self._block_records = 0
+        self._block_tags = set()
+
+        if self.max_segments:
+            for filename in list_segments(self.directory)[:-self.max_segments]:
+                os.remove(filename)
+                os.remove(filename[:-len('.log')] + '.idx')
+
+    def _close_segment(self):
+        self._map.flush()
+        self._map.close()
+        os.ftruncate(self._fd, self._pos)
+        os.close(self._fd)
+        os.close(self._idx_fd)
+
+    def append(self, payload, tagid=0, msgtype=0, direction=DIR_IN, ts=None, conn=0):
+        ts = self.clock.time() if ts is None else ts
+        size = RECORD_HEADER.size + len(payload)
+        if self._pos + size + 4 > self.segment_size:
+            if self._pos == len(MAGIC):
+                raise ValueError(f"Frame of {len(payload)} bytes doesn't fit in a segment")
+            self._close_segment()
+            self._open_segment()
+
+        if self._block_records == self.BLOCK_RECORDS:
+            self._block_records = 0
+            self._block_tags = set()
+        if self._block_records == 0:
+            self._block_start = (ts, self._pos)
+        if tagid not in self._block_tags:
+            self._block_tags.add(tagid)
+            os.write(self._idx_fd, INDEX_ENTRY.pack(self._block_start[0], tagid, self._block_start[1]))
+        self._block_records += 1
+
+        RECORD_HEADER.pack_into(self._map, self._pos, len(payload), ts, tagid, msgtype, direction, conn)
+        self._map[self._pos + RECORD_HEADER.size:self._pos + size] = payload
+        self._pos += size
+
+    def close(self):
+        if self._map is not None:
+            self._close_segment()
+            self._map = None
+
+"""
+Returns (tagid, message type code) of a JSON-decoded frame for the frame log, 0 for what it doesn't carry or isn't
+valid.
+"""
+def frame_ids(value):
+    if not isinstance(value, dict):
+        return 0, 0
+    tagid = value.get('tagid')
+    name = value.get('type')
+    return (tagid if isinstance(tagid, int) and 0 <= tagid < 1 << 64 else 0,
+        mc.MSG_TYPES.get(name, 0) if isinstance(name, str) else 0)
+
+def list_segments(directory):
+    return sorted(os.path.join(directory, f) for f in os.listdir(directory) if f.startswith('frames-') and f.endswith('.log'))
+
+"""
+FrameLogReader(): Iterates over the frames of a FrameLog directory.
+Segments are memory-mapped read-only and records are decoded one at a time, so whole files are never loaded.
+"""
+class FrameLogReader():
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _index(self, segment):
+        with open(segment[:-len('.log')] + '.idx', 'rb') as fh:
+            return [INDEX_ENTRY.unpack_from(data) for data in iter(lambda: fh.read(INDEX_ENTRY.size), b'') if len(data) == INDEX_ENTRY.size]
+
+    """
+    Yields (timestamp, tagid, conn, msgtype, direction, payload) for the frames with t0 <= timestamp < t1,
+    optionally only those of one tagid. Frames from segments written before connection ids were logged have conn 0.
+    """
+    def frames(self, t0=None, t1=None, tagid=None):
+        t0 = float('-inf') if t0 is None else t0
+        t1 = float('inf') if t1 is None else t1
+        for segment in list_segments(self.directory):
+            index = self._index(segment)
+            if not index or index[0][0] >= t1:
+                continue
+            # Blocks, in file order, as (start timestamp, offset, tagids)
+            blocks = []
+            for ts, tag, offset in index:
+                if not blocks or blocks[-1][1] != offset:
+                    blocks.append((ts, offset, set()))
+                blocks[-1][2].add(tag)
+            # Start at the last block beginning before t0
+            first = max(0, bisect.bisect_right([b[0] for b in blocks], t0) - 1)
+
+            with open(segment, 'rb') as fh:
+                size = os.fstat(fh.fileno()).st_size
+                if size <= len(MAGIC):
+                    continue
+                with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    v1 = m[:len(MAGIC)] == MAGIC_V1
+                    header = RECORD_HEADER_V1 if v1 else RECORD_HEADER
+                    for n in range(first, len(blocks)):
+                        start_ts, offset, tags = blocks[n]
+                        if start_ts >= t1:
+                            return
+                        if tagid is not None and tagid not in tags:
+                            continue
+                        end = blocks[n + 1][1] if n + 1 < len(blocks) else size
+                        pos = offset
+                        while pos + header.size <= end:
+                            if v1:
+                                length, ts, tag, msgtype, direction = header.unpack_from(m, pos)
+                                conn = 0
+                            else:
+                                length, ts, tag, msgtype, direction, conn = header.unpack_from(m, pos)
+                            if length == 0 and ts == 0:
+                                break
+                            payload_pos = pos + header.size
+                            pos = payload_pos + length
+                            if ts >= t1:
+                                return
+                            if ts >= t0 and (tagid is None or tag == tagid):
+                                yield ts, tag, conn, msgtype, direction, m[payload_pos:pos]
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description="Dump frames from a frame log")
+    p.add_argument('directory')
+    p.add_argument('--start', type=float, help="Start timestamp (UNIX time)")
+    p.add_argument('--end', type=float, help="End timestamp (UNIX time)")
+    p.add_argument('--tagid', type=int)
+    args = p.parse_args()
+
+    for ts, tagid, conn, msgtype, direction, payload in FrameLogReader(args.directory).frames(args.start, args.end, args.tagid):
+        print(f"{ts:.6f} {tagid} {conn} {msgtype} {'out' if direction == DIR_OUT else 'in'} {payload!r}")
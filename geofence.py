@@ -0,0 +1,115 @@
+import math
+
+FRAMES = ('uwb', 'gps')
+
+"""
+Zone(): Polygonal zone in UWB coordinates (x, y in metres) or GPS coordinates (lat, lon).
+block tells if a vehicle entering it gets blocked.
+"""
+class Zone():
+    __slots__ = ('name', 'frame', 'xs', 'ys', 'block', 'bbox')
+
+    def __init__(self, name, frame, polygon, block=False):
+        if frame not in FRAMES:
+            raise ValueError(f"Zone {name}: unknown coordinate frame {frame}")
+        if len(polygon) < 3:
+            raise ValueError(f"Zone {name}: a polygon needs at least 3 points")
+        self.name = name
+        self.frame = frame
+        self.xs = tuple(float(p[0]) for p in polygon)
+        self.ys = tuple(float(p[1]) for p in polygon)
+        self.block = block
+        self.bbox = (min(self.xs), min(self.ys), max(self.xs), max(self.ys))
+
+    def contains(self, x, y):
+        # Ray casting: count the edges crossed by a ray going right from the point
+        inside = False
+        xs, ys = self.xs, self.ys
+        j = len(xs) - 1
+        for i in range(len(xs)):
+            if (ys[i] > y) != (ys[j] > y) and x < xs[i] + (y - ys[i]) * (xs[j] - xs[i]) / (ys[j] - ys[i]):
+                inside = not inside
+            j = i
+        return inside
+
+"""
+GridIndex(): Uniform grid over the zones of one coordinate frame.
+Every cell holds the zones whose bounding box overlaps it, so a point is only tested against the zones of its
+cell. Cells are built once, when the configuration is loaded.
+"""
+class GridIndex():
+    def __init__(self, zones, cell_size):
+        self.cell_size = cell_size
+        self.cells = {}
+        for zone in zones:
+            x0, y0, x1, y1 = zone.bbox
+            for ix in range(math.floor(x0 / cell_size), math.floor(x1 / cell_size) + 1):
+                for iy in range(math.floor(y0 / cell_size), math.floor(y1 / cell_size) + 1):
+                    self.cells.setdefault((ix, iy), []).append(zone)
+        self.cells = {cell: tuple(zones) for cell, zones in self.cells.items()}
+
+    def zones_at(self, x, y):
+        candidates = self.cells.get((math.floor(x / self.cell_size), math.floor(y / self.cell_size)), ())
+        return [zone for zone in candidates if zone.contains(x, y)]
+
+"""
+Geofence(): Zones from the 'geofence' configuration section:
+    uwb_cell_size   Grid cell size for UWB zones, in metres (default 5)
+    gps_cell_size   Grid cell size for GPS zones, in degrees (default 0.0001, about 11 m)
+    zones           List of {"name", "frame" ("uwb" or "gps"), "polygon" ([[x, y], ...] or [[lat, lon], ...]),
+                    "block" (optional, block vehicles entering the zone)}
+"""
+class Geofence():
+    def __init__(self, zones, uwb_cell_size=5.0, gps_cell_size=0.0001):
+        self.zones = {zone.name: zone for zone in zones}
+        self.uwb = GridIndex([z for z in zones if z.frame == 'uwb'], uwb_cell_size)
+        self.gps = GridIndex([z for z in zones if z.frame == 'gps'], gps_cell_size)
+
+    @classmethod
+    def from_config(cls, cfg_geofence):
+        if not cfg_geofence:
+            return None
+        zones = [Zone(z['name'], z.get('frame', 'uwb'), z['polygon'], z.get('block', False)) for z in cfg_geofence.get('zones', [])]
+        return cls(zones, cfg_geofence.get('uwb_cell_size', 5.0), cfg_geofence.get('gps_cell_size', 0.0001))
+
+    """
+    Returns the names of the zones containing a position, given as the values of FieldUWBPosition and
+    FieldGPSPosition.
+    """
+    def zones_at(self, uwbpos, gpspos):
+        names = [zone.name for zone in self.uwb.zones_at(uwbpos['xpos'], uwbpos['ypos'])]
+        names += [zone.name for zone in self.gps.zones_at(gpspos['lat'], gpspos['lon'])]
+        return frozenset(names)
+
+"""
+GeofenceTracker(): Zones each tag is in, to turn positions into enter and exit events.
+Zones are tracked by name, so the state carries over configuration reloads.
+"""
+class GeofenceTracker():
+    NONE = frozenset()
+
+    def __init__(self):
+        self.inside = {}
+        self.events = 0
+
+    """
+    Records the zones a tag is in. Returns (entered, exited), the sets of zone names entered and left.
+    """
+    def update(self, tagid, names):
+        previous = self.inside.get(tagid, self.NONE)
+        if names == previous:
+            return self.NONE, self.NONE
+        if names:
+            self.inside[tagid] = names
+        else:
+            self.inside.pop(tagid, None)
+        entered, exited = names - previous, previous - names
+        self.events += len(entered) + len(exited)
+        return entered, exited
+
+    def occupants(self):
+        zones = {}
+        for tagid, names in self.inside.items():
+            for name in names:
+                zones.setdefault(name, []).append(tagid)
+        return zones
@@ -0,0 +1,218 @@
+SEVERITY_BOUNDS = (64, 128, 192)   # Severity buckets: < 64, < 128, < 192 and the rest
+SEVERITY_NAMES = ('low', 'medium', 'high', 'severe')
+DIRECTION_SECTORS = 8               # accel_direction is in 1/256 of a turn, grouped in 8 sectors of 45 degrees
+
+def severity_bucket(severity):
+    for i, bound in enumerate(SEVERITY_BOUNDS):
+        if severity < bound:
+            return i
+    return len(SEVERITY_BOUNDS)
+
+"""
+ImpactCounts(): Counts of a set of impacts: total, per severity bucket and per direction sector, and the
+maximum severity.
+"""
+class ImpactCounts():
+    __slots__ = ('count', 'severity', 'direction', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.severity = [0] * len(SEVERITY_NAMES)
+        self.direction = [0] * DIRECTION_SECTORS
+        self.max = 0
+
+    def add(self, bucket, sector, severity):
+        self.count += 1
+        self.severity[bucket] += 1
+        self.direction[sector] += 1
+        if severity > self.max:
+            self.max = severity
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'severity': dict(zip(SEVERITY_NAMES, self.severity)),
+            'direction': self.direction,
+            'max_severity': self.max
+        }
+
+"""
+SlidingWindow(): Impact counts over the last length seconds.
+The window is split in a fixed number of sub-buckets kept in a ring; the totals are updated as impacts come in
+and as sub-buckets fall out of the window, so adding an impact and reading the totals take constant time and
+memory. The window moves in steps of length / buckets seconds.
+"""
+class SlidingWindow():
+    __slots__ = ('step', 'epochs', 'parts', 'total')
+
+    def __init__(self, length, buckets):
+        self.step = length / buckets
+        self.epochs = [None] * buckets
+        self.parts = [ImpactCounts() for _ in range(buckets)]
+        self.total = ImpactCounts()
+
+    def _advance(self, t):
+        epoch = int(t // self.step)
+        oldest = epoch - len(self.epochs) + 1
+        for i, e in enumerate(self.epochs):
+            if e is not None and e < oldest:
+                # Sub-bucket out of the window, take it off the totals
+                part = self.parts[i]
+                self.total.count -= part.count
+                for j, n in enumerate(part.severity):
+                    self.total.severity[j] -= n
+                for j, n in enumerate(part.direction):
+                    self.total.direction[j] -= n
+                self.parts[i] = ImpactCounts()
+                self.epochs[i] = None
+        return epoch
+
+    def add(self, t, bucket, sector, severity):
+        epoch = self._advance(t)
+        i = epoch % len(self.epochs)
+        self.epochs[i] = epoch
+        self.parts[i].add(bucket, sector, severity)
+        self.total.add(bucket, sector, severity)
+        self.total.max = max(part.max for part in self.parts)
+
+    def counts(self, t):
+        self._advance(t)
+        self.total.max = max(part.max for part in self.parts)
+        return self.total
+
+"""
+TumblingWindow(): Impact counts in consecutive, non-overlapping windows of length seconds (aligned to multiples
+of length). The current window and the last complete one are kept.
+"""
+class TumblingWindow():
+    __slots__ = ('length', 'start', 'current', 'last')
+
+    def __init__(self, length):
+        self.length = length
+        self.start = None
+        self.current = ImpactCounts()
+        self.last = ImpactCounts()
+
+    def _advance(self, t):
+        start = t - t % self.length
+        if start != self.start:
+            self.last = self.current if self.start == start - self.length else ImpactCounts()
+            self.current = ImpactCounts()
+            self.start = start
+
+    def add(self, t, bucket, sector, severity):
+        self._advance(t)
+        self.current.add(bucket, sector, severity)
+
+    def as_dict(self, t):
+        self._advance(t)
+        return {
+            'start': self.start,
+            'current': self.current.as_dict(),
+            'last': self.last.as_dict()
+        }
+
+"""
+ImpactStats(): Sliding and tumbling window statistics of one tag or operator.
+"""
+class ImpactStats():
+    __slots__ = ('sliding', 'tumbling', 'total')
+
+    def __init__(self, sliding_length, sliding_buckets, tumbling_length):
+        self.sliding = SlidingWindow(sliding_length, sliding_buckets)
+        self.tumbling = TumblingWindow(tumbling_length)
+        self.total = 0
+
+    def add(self, t, bucket, sector, severity):
+        self.sliding.add(t, bucket, sector, severity)
+        self.tumbling.add(t, bucket, sector, severity)
+        self.total += 1
+
+    def as_dict(self, t):
+        return {
+            'total': self.total,
+            'sliding': self.sliding.counts(t).as_dict(),
+            'tumbling': self.tumbling.as_dict(t)
+        }
+
+"""
+ImpactAggregator(): Streaming statistics of MsgImpactReport, per tag and per operator (the uid logged in on the
+tag when the impact happened).
+Every report updates the statistics of its tag and operator in constant time, and checks the alert thresholds:
+an alert fires when an impact reaches alert_severity, and when the impacts of a tag or operator in the sliding
+window reach alert_count (once per crossing).
+
+cfg is the 'impacts' section of the configuration:
+    window          Sliding window length in seconds (default 300)
+    window_buckets  Sub-buckets of the sliding window (default 10)
+    tumbling        Tumbling window length in seconds (default 3600)
+    alert_count     Impacts in the sliding window raising an alert (default 5)
+    alert_severity  Severity of a single impact raising an alert (default 192)
+"""
+class ImpactAggregator():
+    def __init__(self, cfg=None):
+        cfg = cfg or {}
+        self.window = cfg.get('window', 300)
+        self.window_buckets = cfg.get('window_buckets', 10)
+        self.tumbling = cfg.get('tumbling', 3600)
+        self.alert_count = cfg.get('alert_count', 5)
+        self.alert_severity = cfg.get('alert_severity', 192)
+        self.by_tag = {}
+        self.by_uid = {}
+        self.reports = 0
+        self.alerts = 0
+
+    def _stats(self, table, key):
+        try:
+            return table[key]
+        except KeyError:
+            stats = table[key] = ImpactStats(self.window, self.window_buckets, self.tumbling)
+            return stats
+
+    """
+    Adds an impact at time t. uid may be None if nobody was logged in. Returns a list of alert messages.
+    """
+    def add(self, tagid, uid, severity, direction, t):
+        self.reports += 1
+        bucket = severity_bucket(severity)
+        sector = (direction & 0xFF) * DIRECTION_SECTORS >> 8
+        alerts = []
+        if severity >= self.alert_severity:
+            alerts.append(f"Impact of severity {severity} on tag {tagid} (uid {uid})")
+        for kind, table, key in (('tag', self.by_tag, tagid), ('uid', self.by_uid, uid)):
+            if key is None:
+                continue
+            stats = self._stats(table, key)
+            stats.add(t, bucket, sector, severity)
+            if stats.sliding.total.count == self.alert_count:
+                alerts.append(f"{self.alert_count} impacts in {self.window} s on {kind} {key}")
+        self.alerts += len(alerts)
+        return alerts
+
+    """
+    Statistics of a tag (kind 'tag') or operator (kind 'uid') at time t, None if it has no impacts.
+    """
+    def query(self, kind, key, t):
+        stats = (self.by_tag if kind == 'tag' else self.by_uid).get(key)
+        return stats.as_dict(t) if stats is not None else None
+
+    """
+    The n tags or operators with most impacts in the sliding window, as (key, count, max severity).
+    """
+    def top(self, kind, t, n=10):
+        table = self.by_tag if kind == 'tag' else self.by_uid
+        rows = []
+        for key, stats in table.items():
+            counts = stats.sliding.counts(t)
+            if counts.count:
+                rows.append((key, counts.count, counts.max))
+        rows.sort(key=lambda row: (-row[1], -row[2]))
+        return rows[:n]
+
+    def summary(self):
+        return {
+            'reports': self.reports,
+            'alerts': self.alerts,
+            'tags': len(self.by_tag),
+            'operators': len(self.by_uid)
+        }
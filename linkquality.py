@@ -0,0 +1,124 @@
+import message_codecs as mc
+
+"""
+FrameWindow(): Sliding window over the 16-bit frame counters received from one tag.
+highest is the newest counter seen; bit i of bitmap is set if counter highest - i was received. Counters are
+compared modulo 2**16, so the window works across wraparound. A counter ahead of highest moves the window (the
+counters skipped are counted as lost), one inside the window is either a duplicate or a late frame (reordered,
+no longer lost). span is the number of counters the window covers since it (re)started; older late frames are
+accepted without adjusting the loss count, as they were never counted as lost.
+Counters further behind are stale: too old to tell duplicates from late frames, they're let through and counted
+apart, leaving the window alone. The window restarts (resyncs) on a jump ahead of MAX_GAP or more, or after
+RESYNC_STALE stale frames in a row, as happens when a tag reboots and its counter starts over.
+"""
+class FrameWindow():
+    SIZE = 64           # Frames kept in the bitmap
+    MAX_GAP = 1024      # Largest jump ahead counted as loss rather than a restart
+    RESYNC_STALE = 3    # Stale frames in a row taken as a restarted counter
+    __slots__ = ('highest', 'bitmap', 'span', 'received', 'duplicates', 'lost', 'reordered', 'stale', 'resyncs', 'stale_run')
+
+    def __init__(self, counter):
+        self.highest = counter
+        self.bitmap = 1
+        self.span = 1
+        self.received = 1
+        self.duplicates = 0
+        self.lost = 0
+        self.reordered = 0
+        self.stale = 0
+        self.resyncs = 0
+        self.stale_run = 0
+
+    """
+    Records a frame counter. Returns False if the frame is a duplicate.
+    """
+    def accept(self, counter):
+        ahead = (counter - self.highest) & 0xFFFF
+        behind = 0x10000 - ahead
+        if ahead < self.MAX_GAP or behind < self.SIZE:
+            self.stale_run = 0
+        if ahead == 0:
+            self.duplicates += 1
+            return False
+        if ahead < self.MAX_GAP:
+            self.bitmap = ((self.bitmap << ahead) | 1) & ((1 << self.SIZE) - 1)
+            self.highest = counter
+            self.span = min(self.SIZE, self.span + ahead)
+            self.lost += ahead - 1
+            self.received += 1
+            return True
+        if behind < self.span:
+            bit = 1 << behind
+            if self.bitmap & bit:
+                self.duplicates += 1
+                return False
+            self.bitmap |= bit
+            self.reordered += 1
+            self.lost -= 1
+            self.received += 1
+            return True
+        if behind < self.SIZE:
+            self.reordered += 1
+            self.received += 1
+            return True
+        if ahead > 0x8000:
+            self.stale_run += 1
+            if self.stale_run < self.RESYNC_STALE:
+                self.stale += 1
+                self.received += 1
+                return True
+        self.stale_run = 0
+        self.highest = counter
+        self.bitmap = 1
+        self.span = 1
+        self.resyncs += 1
+        self.received += 1
+        return True
+
+    def as_dict(self):
+        return {
+            'received': self.received,
+            'duplicates': self.duplicates,
+            'lost': self.lost,
+            'reordered': self.reordered,
+            'stale': self.stale,
+            'resyncs': self.resyncs,
+            'loss_ratio': self.lost / (self.received + self.lost)
+        }
+
+"""
+LinkQuality(): Duplicate filter and loss statistics for the vehicle reports of every tag.
+It works on the JSON-decoded frame, before the message object is built, so duplicates cost a dictionary lookup
+and a few integer operations.
+"""
+class LinkQuality():
+    def __init__(self):
+        self.windows = {}
+
+    """
+    Returns False if value (a decoded frame) is a MsgVehicleReport already received. Other frames, and reports
+    without tagid or frame counter (left for the decoder to reject), always pass.
+    """
+    def accept(self, value):
+        if value.get('type') != mc.MsgVehicleReport.NAME:
+            return True
+        tagid = value.get('tagid')
+        counter = value.get('frame_counter')
+        if not isinstance(counter, int):
+            return True
+        window = self.windows.get(tagid)
+        if window is None:
+            self.windows[tagid] = FrameWindow(counter & 0xFFFF)
+            return True
+        return window.accept(counter & 0xFFFF)
+
+    def stats(self):
+        totals = dict.fromkeys(('received', 'duplicates', 'lost', 'reordered', 'stale', 'resyncs'), 0)
+        for window in self.windows.values():
+            for k in totals:
+                totals[k] += getattr(window, k)
+        totals['loss_ratio'] = totals['lost'] / (totals['received'] + totals['lost']) if totals['received'] else 0.0
+        return {
+            'total': totals,
+            'tags': {str(tagid): window.as_dict() for tagid, window in self.windows.items()}
+        }
@@ -0,0 +1,88 @@
+import logging
+import logging.handlers
+import multiprocessing as mp
+import random
+import sys
+import time
+
+LOG_FORMAT = '%(asctime)-15s %(levelname)s %(message)s'
+
+"""
+Lazy(): Defers rendering of a log argument until the record is actually emitted.
+Usage: log.info("Received %s", Lazy(msg.as_dict)). fn is only called if the record passes the level and filters.
+"""
+class Lazy():
+    __slots__ = ('_fn', '_args')
+
+    def __init__(self, fn, *args):
+        self._fn = fn
+        self._args = args
+
+    def __str__(self):
+        return str(self._fn(*self._args))
+
+"""
+MsgTypeFilter(): Rate limits or samples records of high volume message types.
+Records are matched through their 'msgtype' attribute (passed as extra={'msgtype': msg.NAME}), records without
+it always pass. limits maps message type names to either:
+    {"rate": records_per_second, "burst": max_burst}    Token bucket
+    {"sample": fraction}                                Random sampling
+The number of dropped records per type is kept in self.dropped.
+"""
+class MsgTypeFilter(logging.Filter):
+    def __init__(self, limits):
+        super().__init__()
+        self._limits = limits
+        self._buckets = {}  # msgtype -> [tokens, last refill time]
+        self.dropped = {}
+
+    def filter(self, record):
+        msgtype = getattr(record, 'msgtype', None)
+        limit = self._limits.get(msgtype)
+        if limit is None:
+            return True
+
+        if 'sample' in limit:
+            passed = random.random() < limit['sample']
+        else:
+            now = time.monotonic()
+            burst = limit.get('burst', limit['rate'])
+            bucket = self._buckets.setdefault(msgtype, [burst, now])
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * limit['rate'])
+            bucket[1] = now
+            passed = bucket[0] >= 1
+            if passed:
+                bucket[0] -= 1
+
+        if not passed:
+            self.dropped[msgtype] = self.dropped.get(msgtype, 0) + 1
+        return passed
+
+"""
+Configures the root logger of the main process to send its records through a queue to a single background
+writer thread, which does the actual (blocking) stderr output.
+Returns the logger, the queue (to be handed to subprocesses) and the listener, which must be stopped on exit
+to flush pending records.
+"""
+def setup(level, cfg_log=None):
+    log_q = mp.Queue()
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    listener = logging.handlers.QueueListener(log_q, handler, respect_handler_level=True)
+    listener.start()
+    return attach(log_q, level, cfg_log), log_q, listener
+
+"""
+Points the root logger of the current process at log_q. Called in the main process by setup() and at the start
+of every subprocess, which then share the background writer of the main process.
+"""
+def attach(log_q, level, cfg_log=None):
+    cfg_log = cfg_log or {}
+    handler = logging.handlers.QueueHandler(log_q)
+    handler.addFilter(MsgTypeFilter(cfg_log.get('limits', {})))
+    log = logging.getLogger()
+    for h in list(log.handlers):
+        log.removeHandler(h)
+    log.addHandler(handler)
+    log.setLevel(level)
+    return log
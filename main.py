@@ -3,13 +3,31 @@ import argparse
 import multiprocessing as mp
 import json
 import message_codecs as mc
-from time import sleep, time
+import time
+from time import perf_counter_ns
 import logging
 import queue
 import random
 import threading
 import os
+import logpipe
+from logpipe import Lazy
 from userterminal import UserTerminal
+from config import RuntimeConfig, ConfigWatcher
+from checklist_store import ChecklistStore
+from telemetry import TelemetryStore
+from tagfarm import TagFarm
+from reportgen import ReportGenerator
+from geofence import GeofenceTracker
+from impacts import ImpactAggregator
+from timesync import TimeSync
+import audit
+from audit import AuditStore
+import checklist_eval
+from metrics import Metrics, queue_depth, dump_stats
+from tracing import Tracer
+from profiling import Profiler
+from clock import WallClock, VirtualClock
 
 """
 Counter class, increments its value automatically on each read.
@@ -43,32 +61,123 @@ class KeyboardReader(threading.Thread):
 
 """
 Main program
+argv are the command line arguments (sys.argv by default). terminal replaces the UserTerminal process with an
+object providing the same interface and its own manager queue (mgr_q), like replay.LocalTerminal. Without
+keyboard, commands are only taken from keyb_queue. clock is the clock used for timestamps, timers and the loop
+delay (see clock.py), WallClock by default; with a VirtualClock, simulated runs go faster than real time.
+With --simulate, Main runs that way on its own: a VirtualClock, a replay.LocalTerminal with a connection per tag
+(--sim-tags of them) and the report generator (at --sim-rate reports per second), see simulate(). Simulated runs
+start at SIM_EPOCH and draw reports and checklists from --seed, so the same arguments give the same run.
 """
 class Main():
-    def __init__(self):
+    LOOP_DELAY = 0.01
+    BATCH_SIZE = 64     # Frames taken from the main queue per pass
+    SIM_EPOCH = 1704067200.0    # UNIX time simulated runs start at (2024-01-01 00:00 UTC)
+
+    def __init__(self, argv=None, terminal=None, keyboard=True, clock=None):
         # Parse command line arguments
         p = argparse.ArgumentParser()
         p.add_argument('--config', '-c', help="Configuration file", default="/etc/tag-dummy.json")
         p.add_argument('--loglevel', '-l', choices=['debug', 'info', 'warning', 'error', 'critical'], default='debug', help="Logging level")
-        args = p.parse_args()
+        p.add_argument('--profile', '-p', metavar='DIR', nargs='?', const='.', help="Profile both processes, writing the profiles to DIR on shutdown")
+        p.add_argument('--capture', metavar='DIR', help="Capture inbound and outbound frames to a frame log in DIR, for replay.py")
+        p.add_argument('--simulate', metavar='SECONDS', type=float, help="Run SECONDS of simulated fleet traffic on a virtual clock, then print the stats and exit")
+        p.add_argument('--sim-tags', metavar='N', type=int, help="Number of simulated tags (default: 'tags' of the configuration)")
+        p.add_argument('--sim-rate', metavar='HZ', type=float, help="Vehicle reports per second of every simulated tag (default: 'reports' of the configuration)")
+        p.add_argument('--seed', type=int, default=0, help="Seed of the simulated reports and checklists (default 0)")
+        args = p.parse_args(argv)
 
-        # Read configuration
-        with open(args.config) as cfgh:
-            self.cfg = json.load(cfgh)
+        self.simulation = args.simulate
+        if self.simulation is not None:
+            clock = clock or VirtualClock(self.SIM_EPOCH)
+            keyboard = False
+        self.clock = clock or WallClock()
+
+        # Read configuration. The watcher reloads it in the background when the file changes (or on the "reload"
+        # command), and the new one is swapped in by the main loop.
+        self.rt = RuntimeConfig.load(args.config)
+        self.config_watcher = ConfigWatcher(args.config, self.cfg.get('config_poll_interval', 1.0), self.cfg)
+        if self.simulation is not None:
+            # The simulation settings go into the configuration, which isn't reloaded during the run
+            if args.sim_tags is not None:
+                self.cfg['tags'] = args.sim_tags
+            self.cfg['reports'] = dict(self.cfg.get('reports', {}), seed=args.seed)
+            if args.sim_rate is not None:
+                self.cfg['reports']['report_rate'] = args.sim_rate
+            self.cfg['checklist_seed'] = args.seed
+        else:
+            self.config_watcher.start()
 
         # Set up logging
-        logging.basicConfig(format='%(asctime)-15s %(levelname)s %(message)s')
-        self.log = logging.getLogger()
-        self.log.setLevel(args.loglevel.upper())
+        self.log, self.log_q, self.log_listener = logpipe.setup(args.loglevel.upper(), self.cfg.get('logging'))
+
+        # Metrics. The UserTerminal process reports its own set periodically through the main queue.
+        self.metrics = Metrics()
+        self.ut_stats = None
+        self.stats_cfg = self.cfg.get('stats', {})
+        if 'file' in self.stats_cfg:
+            self.clock.call_later(self.stats_cfg.get('interval', 10), self.dump_stats)
 
-        self._mq = mp.Queue()   # Main queue
-        self.ut = UserTerminal(self.cfg['bluetooth'], self._mq, self.log)
+        # Message tracing. The trace of the message being processed is kept in current_trace, so replies
+        # sent while handling it can be tied to it.
+        self.tracer = Tracer(self.cfg.get('trace'))
+        self.current_trace = None
+
+        # Profiling. With --profile the whole run is profiled, otherwise profiling windows can be opened with the
+        # "profile start" and "profile stop" commands.
+        self.profiler = Profiler('main', args.profile or '.')
+        if args.profile is not None:
+            self.profiler.start()
+
+        # Simulated tags, one per terminal connection (see tagfarm.py)
+        self.tags = TagFarm.from_config(self.cfg)
+
+        cfg_framelog = self.cfg.get('framelog')
+        if args.capture is not None:
+            cfg_framelog = dict(cfg_framelog or {}, directory=args.capture, capture=True)
+        if terminal is None and self.simulation is not None:
+            from replay import LocalTerminal
+            terminal = LocalTerminal(keep_sent=False, cfg_admission=self.cfg.get('admission'), clock=self.clock, cfg_framelog=cfg_framelog)
+        if terminal is None:
+            self._mq = mp.Queue()   # Main queue
+            cfg_bt = dict(self.cfg['bluetooth'])
+            cfg_bt.setdefault('max_connections', len(self.tags))
+            self.ut = UserTerminal(cfg_bt, self._mq, self.log_q, args.loglevel.upper(), self.cfg.get('trace'), self.cfg.get('logging'), args.profile, cfg_framelog, cfg_admission=self.cfg.get('admission'))
+        else:
+            self._mq = terminal.mgr_q
+            self.ut = terminal
 
-        self.checklists = []
+        # Audit trail of logins, checklist versions and responses, question responses and block status changes, if
+        # configured. Records are written by a background thread, see audit.py.
+        self.audit_store = AuditStore.from_config(self.cfg.get('audit'))
+
+        # Checklists are drawn from the question bank with their own generator, so runs with a fixed
+        # 'checklist_seed' produce the same sequence of checklists
+        self.checklist_rng = random.Random(self.cfg.get('checklist_seed'))
+        self.checklists = ChecklistStore(self.cfg.get('checklist_history', ChecklistStore.CAPACITY))
         self.create_new_checklist()
 
+        # Synthetic vehicle and impact reports of the simulated tags, if configured
+        if 'reports' in self.cfg:
+            self.reports = ReportGenerator(self.cfg['reports'], self.tags, self.clock, lambda msg, tag: self.send(msg, conn=tag.conn))
+        else:
+            self.reports = None
+
+        # Geofence zones each tag is in. The zones themselves come with the configuration (self.rt.geofence).
+        self.zone_tracker = GeofenceTracker()
+
+        # Impact statistics per tag and operator, fed by MsgImpactReport
+        self.impacts = ImpactAggregator(self.cfg.get('impacts'))
+
+        # Answers time requests of the terminals and probes them for round trip and clock offset estimates
+        self.timesync = TimeSync(self.cfg.get('timesync'), self.tags, self.clock, lambda msg, conn: self.send(msg, conn=conn), self._mq)
+
+        # Position history of the tags, fed by MsgVehicleReport
+        self.telemetry = TelemetryStore(self.cfg.get('telemetry_capacity', TelemetryStore.CAPACITY))
+
         self.keyb_queue = queue.Queue()
-        self.keyboard_reader = KeyboardReader(self.keyb_queue)
+        if keyboard:
+            self.keyboard_reader = KeyboardReader(self.keyb_queue)
 
     def cmd_interpreter(self, cmd):
         # Update the checklist and send it to the user terminal
@@ -83,13 +192,83 @@ class Main():
                 'responses': dict(zip(range(len(responses)), responses))
             }
             msg = mc.MsgUserQuestion({'question_id': os.urandom(1)[0], 'user_question': question_data})
-            self.log.info(f"Sending user_question: {msg.as_dict()}")
-            self.ut.send(msg.as_json().encode())
+            self.log_msg("Sending user_question:", msg)
+            self.send(msg.as_json().encode(), msg.NAME)
+
+        # Show the state of every tag, or of some tags
+        elif cmd.find("tags") == 0:
+            args = cmd.split()[1:]
+            if not all(x.isdigit() for x in args):
+                print("Usage: tags [tagid ...]")
+            elif args:
+                for tagid in map(int, args):
+                    tag = self.tags.by_tagid.get(tagid)
+                    print(tag.as_dict() if tag else f"Unknown tag {tagid}")
+            else:
+                print(self.tags.summary())
 
         elif cmd.find("send checklist version") == 0:
-            msg = mc.MsgChecklistVersionNotification({'checklist_version': len(self.checklists)})
-            self.log.info(f"Sending {msg.as_dict()}")
-            self.ut.send(msg.as_json().encode())
+            msg = mc.MsgChecklistVersionNotification({'checklist_version': self.checklists.current.wire_version})
+            self.log_msg("Sending", msg)
+            self.send(msg.as_json().encode(), msg.NAME)
+
+        # Start or stop a profiling window in both processes
+        elif cmd in ("profile start", "profile stop"):
+            action = cmd.split()[1]
+            if action == "start":
+                self.profiler.start()
+            else:
+                filename = self.profiler.stop()
+                if filename is not None:
+                    self.log.info(f"Main profile written to {filename}")
+            self.ut.profile(action)
+
+        # Reload configuration file
+        elif cmd == "reload":
+            self.config_watcher.reload()
+
+        # Show the latest position of every tag, or of one tag
+        elif cmd.find("telemetry") == 0:
+            args = cmd.split()[1:]
+            if not all(x.isdigit() for x in args):
+                print("Usage: telemetry [tagid ...]")
+            else:
+                for tagid in [int(x) for x in args] or list(self.telemetry.tracks):
+                    print(tagid, self.telemetry.latest(tagid))
+
+        # Show the tags inside every geofence zone
+        elif cmd == "zones":
+            for name, tagids in sorted(self.zone_tracker.occupants().items()):
+                print(name, tagids)
+
+        # Impact statistics: "impacts" for the top tags and operators, "impacts tag <tagid>" or
+        # "impacts uid <uid>" for the windows of one of them
+        elif cmd.find("impacts") == 0:
+            args = cmd.split()[1:]
+            now = self.clock.time()
+            if len(args) == 2 and args[0] in ('tag', 'uid') and args[1].isdigit():
+                print(json.dumps(self.impacts.query(args[0], int(args[1]), now), indent=2))
+            else:
+                print(self.impacts.summary())
+                print("tags:", self.impacts.top('tag', now))
+                print("operators:", self.impacts.top('uid', now))
+
+        # Latest audit records of a tag or operator: "audit tag <tagid>" or "audit uid <uid>"
+        elif cmd.find("audit") == 0:
+            args = cmd.split()[1:]
+            if self.audit_store is None:
+                print("Audit store not configured")
+            elif len(args) == 2 and args[0] in ('tag', 'uid') and args[1].isdigit():
+                key = int(args[1])
+                records = self.audit_store.query(tagid=key) if args[0] == 'tag' else self.audit_store.query(uid=key)
+                for record in reversed(records):
+                    print(record)
+            else:
+                print(self.audit_store.stats())
+
+        # Dump current metrics
+        elif cmd == "stats":
+            print(json.dumps(self.stats(), indent=2))
 
         else:
             self.log.warning(f"Unknown command {cmd}")
@@ -103,91 +282,288 @@ class Main():
             self.log.debug(cmd)
             self.cmd_interpreter(cmd)
 
-    def send_current_checklist(self):
-        # Send ChecklistUpdate
-        checklist_dict = [self.cfg['checklist_questions'][i] for i in self.picked_questions]
-        checklist_msg = mc.MsgChecklistUpdate({
-            'checklist_version': len(self.checklists),
-            'checklist_data': checklist_dict
-        })
-        self.log.info(checklist_msg.as_json())
-        self.ut.send(checklist_msg)
+    """
+    Logs a message object. The message is only rendered if the record is emitted, and the record carries the
+    message type so high volume types can be rate limited (see logpipe.MsgTypeFilter).
+    """
+    def log_msg(self, text, msg, level=logging.INFO):
+        if self.log.isEnabledFor(level):
+            self.log.log(level, "%s %s", text, Lazy(msg.as_dict), extra={'msgtype': msg.NAME})
+
+    """
+    Sends a message object or a pre-encoded payload (bytes) to the terminal on connection conn, or to every
+    connected terminal if conn is None. For pre-encoded payloads, name is the message type name used in metrics
+    and traces.
+    """
+    def send(self, msg, name=None, conn=None):
+        name = name or getattr(msg, 'NAME', 'raw')
+        if self.current_trace is not None:
+            trace = {'id': self.current_trace['id'], 'reply': name, 'stages': {'outbound_enqueue': self.clock.monotonic()}}
+        else:
+            trace = None
+        self.ut.send(msg, trace, name, conn)
+
+    def stats(self):
+        self.metrics.gauge('main_queue_depth', queue_depth(self._mq))
+        self.metrics.gauge('terminal_queue_depth', queue_depth(self.ut._proc_q))
+        return {
+            'time': self.clock.time(),
+            'main': self.metrics.snapshot(),
+            'tags': self.tags.summary(),
+            'reports': self.reports.stats() if self.reports is not None else None,
+            'geofence_events': self.zone_tracker.events,
+            'impacts': self.impacts.summary(),
+            'audit': self.audit_store.stats() if self.audit_store is not None else None,
+            'timesync': self.timesync.stats(),
+            'terminal': self.ut_stats
+        }
+
+    # Periodic timer, set up in __init__ when a stats file is configured
+    def dump_stats(self):
+        try:
+            dump_stats(self.stats(), self.stats_cfg['file'])
+        except OSError as e:
+            self.log.error(f"Unable to write stats file: {e}")
+        self.clock.call_later(self.stats_cfg.get('interval', 10), self.dump_stats)
+
+    @property
+    def cfg(self):
+        return self.rt.cfg
+
+    def apply_config_updates(self):
+        try:
+            error = self.config_watcher.errors.get_nowait()
+        except queue.Empty:
+            pass
+        else:
+            self.log.error(f"Configuration not reloaded: {error}")
+
+        try:
+            rt = self.config_watcher.updates.get_nowait()
+        except queue.Empty:
+            return
+        old_rt, self.rt = self.rt, rt
+        old_rt.close()
+        self.log.info("Configuration reloaded")
+        # Settings read on every use take effect from now on. The ones read once at startup (bluetooth, logging,
+        # stats, trace, framelog, admission) only change with a restart.
+        if rt.questions != old_rt.questions or rt.num_questions != old_rt.num_questions or rt.zdict != old_rt.zdict:
+            self.log.info("Checklist questions changed, creating a new checklist")
+            self.create_new_checklist()
+
+    def send_current_checklist(self, tag=None):
+        # Send ChecklistUpdate to the terminal of tag, or to all of them. The payloads were encoded when the version was created.
+        current = self.checklists.current
+        conn = None if tag is None else tag.conn
+        # Segment frames carry 31 bytes each, base64 encoded: they only take less airtime than the single update with
+        # checklist_compression on
+        if self.cfg.get('checklist_transfer', 'json') == 'segments':
+            self.log.info(f"Sending checklist version {current.wire_version} in {len(current.segments) - 1} segments")
+            for name, frame in current.segments:
+                self.send(frame, name, conn)
+        else:
+            self.log.info(f"Sending checklist version {current.wire_version}")
+            self.log.debug("Sending %s", Lazy(current.update_json.decode), extra={'msgtype': mc.MsgChecklistUpdate.NAME})
+            self.send(current.update_json, mc.MsgChecklistUpdate.NAME, conn)
+        for t in ([tag] if tag is not None else self.tags.connected()):
+            t.checklist_version = current.wire_version
 
     def create_new_checklist(self):
         # Pick some questions from the set
-        self.picked_questions = random.sample(range(len(self.cfg['checklist_questions'])), self.cfg['checklist_num_questions'])
+        picked_questions = self.rt.bank.draw(self.rt.num_questions, self.checklist_rng, self.rt.vehicle_type, self.rt.categories)
         # Keep checklist in local storage, to be able to check against it in future MsgChecklistResponse messages
-        self.checklists.append(self.picked_questions)
+        version = self.checklists.add(self.rt.questions, picked_questions, self.rt.zdict)
+        # Its masks go to the audit trail, for evaluating the responses in bulk later (audit.py --evaluate)
+        if self.audit_store is not None:
+            self.audit_store.record(audit.CHECKLIST_VERSION, None, None, {'checklist_version': version.wire_version, 'masks': version.masks.as_dict()}, self.clock.time())
         # Send checklist to terminal
         self.send_current_checklist()
         
-    def process_msg_from_terminal(self, msg):
+    def record_audit(self, kind, tag, data):
+        if self.audit_store is not None:
+            self.audit_store.record(kind, tag.tagid, tag.uid, data, self.clock.time())
+
+    """
+    Handles a message received from the terminal serving tag (a tagfarm.TagState). Replies go to that terminal only.
+    """
+    def process_msg_from_terminal(self, msg, tag):
         # MsgLoginRequest
         if isinstance(msg, mc.MsgLoginRequest):
-            if str(msg.uid.value) in self.cfg['userdb']:
-                # If user valid, reply login ok
+            # The response (login ok or login error) comes pre-encoded from the user store
+            response = self.rt.users.login_response(msg.uid.value)
+            if response.valid:
                 self.log.info(f"User {msg.uid.value} valid!")
-                userinfo = self.cfg['userdb'][str(msg.uid.value)]
-                self.ut.send(mc.MsgLoginResponse({ 'response': True, 'uid': msg.uid.value, 'username': userinfo['username'], 'profile': userinfo['profile'] }))
-                del userinfo
+                tag.uid = msg.uid.value
             else:
-                # If user not in database, reply login error
                 self.log.info(f"User {msg.uid.value} invalid!")
-                self.ut.send(mc.MsgLoginResponse({ 'response': False, 'uid': msg.uid.value, 'username': "", 'profile': 255 }))
+            self.send(response.json, mc.MsgLoginResponse.NAME, tag.conn)
+            self.record_audit(audit.LOGIN, tag, {'uid': msg.uid.value, 'valid': response.valid})
 
         # MsgSetBlockStatus
         elif isinstance(msg, mc.MsgSetBlockStatus):
-            print("Vehicle", "blocked" if msg.block_status else "unblocked")
+            print("Vehicle", tag.tagid, "blocked" if msg.block_status else "unblocked")
+            tag.blocked = bool(msg.block_status)
+            self.record_audit(audit.BLOCK_STATUS, tag, {'block_status': tag.blocked, 'source': 'terminal'})
         
         # MsgLogoutNotification
         elif isinstance(msg, mc.MsgLogoutNotification):
             self.log.info(f"User logged out by terminal request")
+            tag.uid = None
 
         # MsgChecklistResponses
         elif isinstance(msg, mc.MsgChecklistResponses):
-            self.log.info(f"Received {msg.as_dict()}")
+            self.log_msg("Received", msg)
+            version = self.checklists.get(msg.checklist_version)
+            record = {'checklist_version': msg.checklist_version, 'yes_mask': msg.yes_mask, 'answered_mask': msg.answered_mask, 'evaluation': None}
+            if version is None:
+                self.log.warning(f"Checklist responses for unknown version {msg.checklist_version}")
+                self.record_audit(audit.CHECKLIST_RESPONSES, tag, record)
+            else:
+                result = checklist_eval.evaluate(version.masks, msg.yes_mask, msg.answered_mask, self.cfg.get('checklist_block_unanswered', False))
+                self.log.info(f"Checklist version {version.wire_version} evaluated: {result.as_dict()}")
+                record['evaluation'] = result.as_dict()
+                self.record_audit(audit.CHECKLIST_RESPONSES, tag, record)
+                if result.blocked:
+                    # A critical question was answered wrong, block the vehicle
+                    self.log.warning("Critical checklist answers failed, blocking vehicle")
+                    self.send(mc.MsgSetBlockStatus({'tagid': tag.tagid, 'block_status': True}), conn=tag.conn)
+                    tag.blocked = True
+                    self.record_audit(audit.BLOCK_STATUS, tag, {'block_status': True, 'source': 'checklist'})
 
         # MsgChecklistVersionNotification
         elif isinstance(msg, mc.MsgChecklistVersionNotification):
-            self.log.info(f"Received {msg.as_dict()}")
-            if msg.checklist_version != len(self.checklists):
-                self.log.info(f"Sending checklist update (current_version={len(self.checklists)}, remote_version={msg.checklist_version})")
-                self.send_current_checklist()
+            self.log_msg("Received", msg)
+            current_version = self.checklists.current.wire_version
+            tag.checklist_version = msg.checklist_version
+            if msg.checklist_version != current_version:
+                # If the terminal's version is still in the history, a delta update may do
+                base = self.checklists.get(msg.checklist_version)
+                delta = None
+                if base is not None and self.cfg.get('checklist_delta', False):
+                    delta = self.checklists.current.delta_from(base)
+                if delta is not None:
+                    self.log.info(f"Sending checklist delta update (current_version={current_version}, remote_version={msg.checklist_version})")
+                    self.send(delta, mc.MsgChecklistDelta.NAME, tag.conn)
+                    tag.checklist_version = current_version
+                else:
+                    self.log.info(f"Sending checklist update (current_version={current_version}, remote_version={msg.checklist_version})")
+                    self.send_current_checklist(tag)
             else:
                 self.log.info(f"User terminal checklist version is updated (version={msg.checklist_version}. Not sending update.")
         
         # MsgUserQuestionResponse
         elif isinstance(msg, mc.MsgUserQuestionResponse):
-            self.log.info(f"Received {msg.as_dict()}")
+            self.log_msg("Received", msg)
+            self.record_audit(audit.QUESTION_RESPONSE, tag, {'question_id': msg.question_id, 'response_mask': msg.response_mask})
+
+        # MsgVehicleReport
+        elif isinstance(msg, mc.MsgVehicleReport):
+            self.log_msg("Received", msg, logging.DEBUG)
+            self.telemetry.add_report(msg, self.clock.time())
+            if self.rt.geofence is not None:
+                self.check_geofence(msg, tag)
 
         # MsgImpactReport
         elif isinstance(msg, mc.MsgImpactReport):
-            self.log.info(f"Received {msg.as_dict()}")
+            self.log_msg("Received", msg)
+            for alert in self.impacts.add(msg.tagid.value, tag.uid, msg.severity, msg.accel_direction, self.clock.time()):
+                self.log.warning(alert)
+
+        # MsgTimeRequest
+        elif isinstance(msg, mc.MsgTimeRequest):
+            self.send(self.timesync.answer(), conn=tag.conn)
+
+        # MsgTimeSet, the answer to a time probe
+        elif isinstance(msg, mc.MsgTimeSet):
+            self.timesync.time_set(tag.conn, msg)
+
+        # MsgTagConfig
+        elif isinstance(msg, mc.MsgTagConfig):
+            self.log_msg("Received", msg)
+            if self.reports is not None:
+                self.reports.configure(tag, msg.report_rate, msg.crash_sens)
         
         else:
-            self.log.warning(f"Message of type {type(msg)} unexpected")
+            self.log.warning("Message of type %s unexpected", type(msg), extra={'msgtype': msg.NAME})
+
+    """
+    Updates the zones of the tag reporting its position in msg (a MsgVehicleReport) and reacts to zone changes:
+    entering a blocking zone blocks the vehicle.
+    """
+    def check_geofence(self, msg, tag):
+        tagid = msg.tagid.value
+        entered, exited = self.zone_tracker.update(tagid, self.rt.geofence.zones_at(msg.uwbpos.value, msg.gpspos.value))
+        for name in exited:
+            self.log.info(f"Tag {tagid} left zone {name}")
+        for name in entered:
+            zone = self.rt.geofence.zones[name]
+            self.log.warning(f"Tag {tagid} entered zone {name}")
+            if zone.block and not tag.blocked:
+                self.log.warning(f"Blocking vehicle {tag.tagid} in zone {name}")
+                self.send(mc.MsgSetBlockStatus({'tagid': tag.tagid, 'block_status': True}), conn=tag.conn)
+                tag.blocked = True
+                self.record_audit(audit.BLOCK_STATUS, tag, {'block_status': True, 'source': f"geofence {name}"})
+
+    def process_terminal_frame(self, obj):
+        if 'type' not in obj:
+            self.metrics.malformed += 1
+            self.log.error(f"Invalid frame in UserTerminal queue: {obj}")
+        elif obj['type'] == 'user_received_malformed':
+            self.log.error(f"Invalid message received: {obj}")
+        elif obj['type'] == 'user_received' and self.tags.attach(obj.get('conn')) is None:
+            self.log.warning(f"No free tag for connection {obj.get('conn')}, message dropped")
+        elif obj['type'] == 'user_received':
+            tag = self.tags.by_conn[obj.get('conn')]
+            trace = obj.get('trace')
+            if trace is not None:
+                trace['stages']['dequeue'] = self.clock.monotonic()
+                self.current_trace = trace
+                trace['stages']['handler_start'] = self.clock.monotonic()
+            t0 = perf_counter_ns()
+            try:
+                self.process_msg_from_terminal(obj['msg'], tag)
+            finally:
+                self.current_trace = None
+            self.metrics.dispatched(obj['msg'].NAME, perf_counter_ns() - t0)
+            if trace is not None:
+                trace['stages']['handler_end'] = self.clock.monotonic()
+                self.tracer.write(trace)
+        elif obj['type'] == 'user_connected':
+            tag = self.tags.attach(obj['conn'])
+            if tag is None:
+                self.log.warning(f"No free tag for connection {obj['conn']}")
+            else:
+                self.log.info(f"Connection {obj['conn']} serving tag {tag.tagid}")
+        elif obj['type'] == 'user_disconnected':
+            self.tags.detach(obj['conn'])
+            self.timesync.forget(obj['conn'])
+        elif obj['type'] == 'user_stats':
+            self.ut_stats = obj['stats']
+        elif obj['type'] == 'user_profile':
+            if obj['file'] is not None:
+                self.log.info(f"UserTerminal profile written to {obj['file']}")
+        elif obj['type'] == 'user_undelivered':
+            self.log.warning(f"Unable to deliver message {obj['msg']}. No connection with user terminal")
+        else:
+            self.log.error(f"Unknown frame type in UserTerminal queue: {obj}")
 
     def single_pass(self):
         done_something = False
 
-        # Receive messages from terminal
-        try:
-            obj = self._mq.get_nowait()
-        except queue.Empty:
-            pass
-        else:
-            if 'type' not in obj:
-                self.log.error(f"Invalid frame in UserTerminal queue: {obj}")
-            if obj['type'] == 'user_received_malformed':
-                self.log.error(f"Invalid message received: {obj}")
-            elif obj['type'] == 'user_received':
-                self.process_msg_from_terminal(obj['msg'])
-            elif obj['type'] == 'user_undelivered':
-                self.log.warning(f"Unable to deliver message {obj['msg']}. No connection with user terminal")
-            else:
-                self.log.error(f"Unknown frame type in UserTerminal queue: {obj}")
+        # Receive messages from terminal, up to batch_size per pass so keyboard commands, configuration updates
+        # and timers still get their turn under load
+        for _ in range(self.cfg.get('batch_size', self.BATCH_SIZE)):
+            try:
+                obj = self._mq.get_nowait()
+            except queue.Empty:
+                break
+            done_something = True
+            self.process_terminal_frame(obj)
 
         self.check_for_keyboard_cmd()
+        self.apply_config_updates()
+        if self.clock.run_due():
+            done_something = True
 
         return done_something
 
@@ -195,17 +571,45 @@ class Main():
         while True:
             if not self.single_pass():
                 # If the loop didn't do anything, put a small delay to avoid hogging the processor.
-                sleep(0.01)
+                # The delay is cut short by due timers (and skipped altogether with a virtual clock).
+                self.clock.wait(self.LOOP_DELAY)
+
+    """
+    Runs the simulation (--simulate): connects a terminal to every tag and runs the loop until the virtual clock has
+    moved the given number of seconds. Returns the stats at the end, along with the wall time taken.
+    """
+    def simulate(self, seconds):
+        for conn in range(len(self.tags)):
+            self.ut.connect(conn)
+        end = self.clock.monotonic() + seconds
+        start = time.perf_counter()
+        while self.clock.monotonic() < end:
+            if not (self.ut.pump() or self.single_pass()):
+                self.clock.wait(self.LOOP_DELAY)
+        stats = self.stats()
+        stats['terminal'] = self.ut.stats()
+        stats['simulation'] = {'simulated_s': seconds, 'wall_s': time.perf_counter() - start}
+        return stats
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, exc_tb):
-        self.ut.terminate()
+        self.ut.stop()
+        filename = self.profiler.stop()
+        if filename is not None:
+            self.log.info(f"Main profile written to {filename}")
+        self.rt.close()
+        if self.audit_store is not None:
+            self.audit_store.close()
+        self.log_listener.stop()
 
 if __name__ == '__main__':
     try:
         with Main() as main:
-            main.loop()
+            if main.simulation is not None:
+                print(json.dumps(main.simulate(main.simulation), indent=2))
+            else:
+                main.loop()
     except KeyboardInterrupt:
         print("interrupted by user")
@@ -1,6 +1,10 @@
+import base64
 import field_codecs as fc
 from itertools import islice
 import json
+import compression
+
+FLAG_COMPRESSED = 0x01  # Segmented payload is zlib-compressed with the question bank preset dictionary
 
 '''
 Message type classes
@@ -59,7 +63,7 @@ class MsgLoginRequest():
         }
 
     def as_json(self):
-        return json.dumps(self.dict())
+        return json.dumps(self.as_dict())
 
 """
 MsgLoginResponse()
@@ -97,8 +101,8 @@ class MsgLoginResponse():
     def as_bytes(self):
         out = bytes([self.TYPE])
         out += bytes([self.response])
-        out += self.username.as_bytes()
         out += self.uid.as_bytes()
+        out += self.username.as_bytes()
         out += bytes([self.profile])
         return out
 
@@ -157,7 +161,9 @@ class MsgLogoutNotification():
 
 """
 MsgChecklistUpdateStart()
-[ type(1) | segments(1) | checklist_version(1) | payload_length(2) ]
+[ type(1) | segments(1) | checklist_version(1) | payload_length(2) | flags(1) ]
+payload_length is the uncompressed length. flags is always sent (0 without compression): the link has no length
+prefix, so the frame is fixed length.
 """
 class MsgChecklistUpdateStart():
     TYPE = 5
@@ -174,6 +180,7 @@ class MsgChecklistUpdateStart():
             self.segments = next(it)
             self.checklist_version = next(it)
             self.length = fc.FieldPayloadLength(bytes(islice(it, fc.FieldPayloadLength.SIZE)))
+            self.flags = next(it)
             assert next(it, None) is None, "Raw input length doesn't correspond with this class"
             
         elif isinstance(value, dict):
@@ -182,6 +189,7 @@ class MsgChecklistUpdateStart():
             self.segments = int(value['segments'])
             self.checklist_version = int(value['checklist_version'])
             self.length = fc.FieldPayloadLength(value['length'])
+            self.flags = int(value.get('flags', 0))
 
         else:
             raise ValueError
@@ -191,6 +199,7 @@ class MsgChecklistUpdateStart():
         out += bytes([self.segments])
         out += bytes([self.checklist_version])
         out += self.length.as_bytes()
+        out += bytes([self.flags])
         return out
 
     def as_dict(self):
@@ -198,7 +207,8 @@ class MsgChecklistUpdateStart():
             'type': self.NAME,
             'segments': self.segments,
             'checklist_version': self.checklist_version,
-            'length': self.length.value
+            'length': self.length.value,
+            'flags': self.flags
         }
 
     def as_json(self):
@@ -207,6 +217,7 @@ class MsgChecklistUpdateStart():
 """
 MsgChecklistUpdateSegment()
 [ type(1) | checklist_version(1) | seq_no(1) | segment(31) ]
+In JSON, segment is base64 encoded (bytes are taken as well when building one).
 """
 class MsgChecklistUpdateSegment():
     TYPE = 6
@@ -230,7 +241,8 @@ class MsgChecklistUpdateSegment():
                 raise ValueError("Packet type unexpected: {value['type']}")
             self.checklist_version = int(value['checklist_version'])
             self.seq_no = int(value['seq_no'])
-            self.segment = fc.FieldChecklistSegment(value['segment'])
+            segment = value['segment']
+            self.segment = fc.FieldChecklistSegment(base64.b64decode(segment) if isinstance(segment, str) else segment)
 
         else:
             raise ValueError
@@ -247,7 +259,7 @@ class MsgChecklistUpdateSegment():
             'type': self.NAME,
             'checklist_version': self.checklist_version,
             'seq_no': self.seq_no,
-            'segment': self.segment.value
+            'segment': base64.b64encode(self.segment.value).decode()
         }
 
     def as_json(self):
@@ -297,9 +309,65 @@ class MsgChecklistUpdate():
     def as_json(self):
         return json.dumps(self.as_dict())
     
+"""
+MsgChecklistDelta()
+[ type(1) | checklist_version(1) | base_version(1) | delta(4096) ]
+Updates a terminal holding checklist base_version to checklist_version (see fc.FieldChecklistDelta).
+"""
+class MsgChecklistDelta():
+    TYPE = 9
+    NAME = 'checklist_delta'
+
+    def __init__(self, value):
+        if isinstance(value, str):
+            value = json.loads(value)
+
+        if isinstance(value, bytes):
+            it = iter(value)
+            if next(it) != self.TYPE:
+                raise ValueError(self.TYPE)
+            self.checklist_version = next(it)
+            self.base_version = next(it)
+            self.delta = fc.FieldChecklistDelta(bytes(islice(it, fc.FieldChecklistDelta.SIZE)))
+            assert next(it, None) is None, "Raw input length doesn't correspond with this class"
+
+        elif isinstance(value, dict):
+            if 'type' in value and value['type'] != self.NAME:
+                raise ValueError("Packet type unexpected: {value['type']}")
+            self.checklist_version = int(value['checklist_version'])
+            self.base_version = int(value['base_version'])
+            self.delta = fc.FieldChecklistDelta(value['delta'])
+
+        else:
+            raise ValueError
+
+    def as_bytes(self):
+        out = bytes([self.TYPE])
+        out += bytes([self.checklist_version])
+        out += bytes([self.base_version])
+        out += self.delta.as_bytes()
+        return out
+
+    def as_dict(self):
+        return {
+            'type': self.NAME,
+            'checklist_version': self.checklist_version,
+            'base_version': self.base_version,
+            'delta': self.delta.value
+        }
+
+    def as_json(self):
+        return json.dumps(self.as_dict())
+
+    """
+    Rebuilds the new checklist data from the base checklist data.
+    """
+    def apply(self, base_checklist_data):
+        return [base_checklist_data[x] if isinstance(x, int) else x for x in self.delta.value]
+
 """
 MsgChecklistResponses()
-[ type(1) | tagid(8) | responses(20) | checklist_version(1) ]
+[ type(1) | tagid(8) | responses(5) | checklist_version(1) ]
 """
 class MsgChecklistResponses():
     TYPE = 8
@@ -345,6 +413,14 @@ class MsgChecklistResponses():
 
     def as_json(self):
         return json.dumps(self.as_dict())
+
+    @property
+    def yes_mask(self):
+        return self.responses.yes_mask
+
+    @property
+    def answered_mask(self):
+        return self.responses.answered_mask
     
 """
 MsgChecklistVersionNotification()
@@ -389,7 +465,8 @@ class MsgChecklistVersionNotification():
     
 """
 MsgUserQuestionStart()
-[ type(1) | question_id(1) | segments(1) | payload_length(2) ]
+[ type(1) | question_id(1) | segments(1) | payload_length(2) | flags(1) ]
+payload_length is the uncompressed length. flags is always sent (see MsgChecklistUpdateStart).
 """
 class MsgUserQuestionStart():
     TYPE = 11
@@ -406,6 +483,7 @@ class MsgUserQuestionStart():
             self.question_id = next(it)
             self.segments = next(it)
             self.length = fc.FieldPayloadLength(bytes(islice(it, fc.FieldPayloadLength.SIZE)))
+            self.flags = next(it)
             assert next(it, None) is None, "Raw input length doesn't correspond with this class"
             
         elif isinstance(value, dict):
@@ -414,6 +492,7 @@ class MsgUserQuestionStart():
             self.question_id = int(value['question_id'])
             self.segments = int(value['segments'])
             self.length = fc.FieldPayloadLength(value['length'])
+            self.flags = int(value.get('flags', 0))
 
         else:
             raise ValueError
@@ -423,6 +502,7 @@ class MsgUserQuestionStart():
         out += bytes([self.question_id])
         out += bytes([self.segments])
         out += self.length.as_bytes()
+        out += bytes([self.flags])
         return out
 
     def as_dict(self):
@@ -430,7 +510,8 @@ class MsgUserQuestionStart():
             'type': self.NAME,
             'question_id': self.question_id,
             'segments': self.segments,
-            'length': self.length.value
+            'length': self.length.value,
+            'flags': self.flags
         }
 
     def as_json(self):
@@ -439,6 +520,7 @@ class MsgUserQuestionStart():
 """
 MsgUserQuestionSegment()
 [ type(1) | question_id(1) | seq_no(1) | data(31) ]
+In JSON, data is base64 encoded (bytes are taken as well when building one).
 """
 class MsgUserQuestionSegment():
     TYPE = 12
@@ -455,7 +537,7 @@ class MsgUserQuestionSegment():
                 raise ValueError(self.TYPE)
             self.question_id = next(it)
             self.seq_no = next(it)
-            self.data = fc.FieldUserQuestionData(bytes(islice(it, fc.FieldUserQuestionData.SIZE)))
+            self.data = fc.FieldUserQuestionSegment(bytes(islice(it, fc.FieldUserQuestionSegment.SIZE)))
             assert next(it, None) is None, "Raw input length doesn't correspond with this class"
             
         elif isinstance(value, dict):
@@ -463,7 +545,8 @@ class MsgUserQuestionSegment():
                 raise ValueError("Packet type unexpected: {value['type']}")
             self.question_id = int(value['question_id'])
             self.seq_no = int(value['seq_no'])
-            self.data = fc.FieldUserQuestionData(value['data'])
+            data = value['data']
+            self.data = fc.FieldUserQuestionSegment(base64.b64decode(data) if isinstance(data, str) else data)
 
         else:
             raise ValueError
@@ -480,7 +563,7 @@ class MsgUserQuestionSegment():
             'type': self.NAME,
             'question_id': self.question_id,
             'seq_no': self.seq_no,
-            'data': self.data.value
+            'data': base64.b64encode(self.data.value).decode()
         }
 
     def as_json(self):
@@ -533,7 +616,7 @@ class MsgUserQuestion():
     
 """
 MsgUserQuestionResponse()
-[ type(1) | tagid(8) | question_id(1) | response(1) ]
+[ type(1) | tagid(8) | question_id(1) | responses(10) ]
 """
 class MsgUserQuestionResponse():
     TYPE = 14
@@ -549,7 +632,7 @@ class MsgUserQuestionResponse():
                 raise ValueError(self.TYPE)
             self.tagid = fc.FieldTagID(bytes(islice(it, fc.FieldTagID.SIZE)))
             self.question_id = next(it)
-            self.responses = fc.FieldUserQuestionResponse(next(it))
+            self.responses = fc.FieldUserQuestionResponse(bytes(islice(it, fc.FieldUserQuestionResponse.SIZE)))
             assert next(it, None) is None, "Raw input length doesn't correspond with this class"
             
         elif isinstance(value, dict):
@@ -579,6 +662,11 @@ class MsgUserQuestionResponse():
 
     def as_json(self):
         return json.dumps(self.as_dict())
+
+    @property
+    def response_mask(self):
+        # Responses as a bitset, bit i set if response i is true
+        return self.responses.mask
     
 """
 MsgImpactReport()
@@ -615,7 +703,7 @@ class MsgImpactReport():
         out = bytes([self.TYPE])
         out += self.tagid.as_bytes()
         out += bytes([self.severity])
-        out += bytes([accel_direction])
+        out += bytes([self.accel_direction])
         return out
 
     def as_dict(self):
@@ -818,6 +906,9 @@ class MsgTagConfig():
     NAME = 'tag_config'
 
     def __init__(self, value):
+        if isinstance(value, str):
+            value = json.loads(value)
+
         if isinstance(value, bytes):
             it = iter(value)
             if next(it) != self.TYPE:
@@ -846,6 +937,7 @@ class MsgTagConfig():
 
     def as_dict(self):
         return {
+            'type': self.NAME,
             'crash_sens': self.crash_sens,
             'report_rate': self.report_rate,
             'vehicle_name': self.vehicle_name.value
@@ -867,6 +959,8 @@ def parse_dict(msg):
         return MsgChecklistUpdateSegment(msg)
     elif msg['type'] == MsgChecklistUpdate.NAME:
         return MsgChecklistUpdate(msg)
+    elif msg['type'] == MsgChecklistDelta.NAME:
+        return MsgChecklistDelta(msg)
     elif msg['type'] == MsgChecklistResponses.NAME:
         return MsgChecklistResponses(msg)
     elif msg['type'] == MsgChecklistVersionNotification.NAME:
@@ -892,72 +986,112 @@ def parse_dict(msg):
     elif msg['type'] == MsgTimeSet.NAME:
         return MsgTimeSet(msg)
     else:
-        raise Exception(f"Message couldn't be parsed: {msg}")
+        raise ValueError(f"Message couldn't be parsed: {msg}")
+
+TYPECODE_TO_MSG = {
+    MsgLoginRequest.TYPE: MsgLoginRequest,
+    MsgLoginResponse.TYPE: MsgLoginResponse,
+    MsgLogoutNotification.TYPE: MsgLogoutNotification,
+    MsgChecklistUpdateStart.TYPE: MsgChecklistUpdateStart,
+    MsgChecklistUpdateSegment.TYPE: MsgChecklistUpdateSegment,
+    MsgChecklistDelta.TYPE: MsgChecklistDelta,
+    MsgChecklistResponses.TYPE: MsgChecklistResponses,
+    MsgChecklistVersionNotification.TYPE: MsgChecklistVersionNotification,
+    MsgUserQuestionStart.TYPE: MsgUserQuestionStart,
+    MsgUserQuestionSegment.TYPE: MsgUserQuestionSegment,
+    MsgUserQuestionResponse.TYPE: MsgUserQuestionResponse,
+    MsgImpactReport.TYPE: MsgImpactReport,
+    MsgVehicleReport.TYPE: MsgVehicleReport,
+    MsgTagConfig.TYPE: MsgTagConfig,
+    MsgSetBlockStatus.TYPE: MsgSetBlockStatus,
+    MsgTimeRequest.TYPE: MsgTimeRequest,
+    MsgTimeSet.TYPE: MsgTimeSet
+}
+
+# Message type codes by name, to tag pre-encoded payloads (whose NAME is known, but not their class)
+MSG_TYPES = {cls.NAME: cls.TYPE for cls in list(TYPECODE_TO_MSG.values()) + [MsgChecklistUpdate, MsgUserQuestion]}
 
 def parse_bytes(msg):
-    typecode_to_msg = {
-        MsgLoginRequest.TYPE: MsgLoginRequest,
-        MsgLoginResponse.TYPE: MsgLoginResponse,
-        MsgLogoutNotification.TYPE: MsgLogoutNotification,
-        MsgChecklistUpdateStart.TYPE: MsgChecklistUpdateStart,
-        MsgChecklistUpdateSegment.TYPE: MsgChecklistUpdateSegment,
-        MsgChecklistResponses.TYPE: MsgChecklistResponses,
-        MsgChecklistVersionNotification.TYPE: MsgChecklistVersionNotification,
-        MsgUserQuestionStart.TYPE: MsgUserQuestionStart,
-        MsgUserQuestionSegment.TYPE: MsgUserQuestionSegment,
-        MsgUserQuestionResponse.TYPE: MsgUserQuestionResponse,
-        MsgImpactReport.TYPE: MsgImpactReport,
-        MsgVehicleReport.TYPE: MsgVehicleReport,
-        MsgTagConfig.TYPE: MsgTagConfig,
-        MsgSetBlockStatus.TYPE: MsgSetBlockStatus,
-        MsgTimeRequest.TYPE: MsgTimeRequest,
-        MsgTimeSet.TYPE: MsgTimeSet
-    }
-    return typecode_to_msg[msg[0]](msg)
+    return TYPECODE_TO_MSG[msg[0]](msg)
 
 def parse_json(msg):
     return parse_dict(json.loads(msg))
 
 """
-Grabs the full checklist_data as a string, generates the MsgChecklistUpdateStart header message and the MsgChecklistUpdateSegment messages
+Splits payload bytes in fixed-size, zero-padded segments.
 """
-def checklist_splitter(checklist_data, checklist_version):
+def split_segments(databytes, size):
     segments = []
-    databytes = json.dumps(checklist_data).encode()
     it = iter(databytes)
     while True:
-        segment = bytes(islice(it, fc.FieldChecklistSegment.SIZE))
-        if len(segment) < fc.FieldChecklistSegment.SIZE:
-            segment += b'\0' * (fc.FieldChecklistSegment.SIZE - len(segment))
+        segment = bytes(islice(it, size))
+        if len(segment) < size:
+            segment += b'\0' * (size - len(segment))
             segments.append(segment)
             break
         else:
             segments.append(segment)
+    return segments
+
+"""
+Rebuilds the payload of a segmented transfer from its start message and segment messages (in any order).
+The payload is decompressed if the start message has FLAG_COMPRESSED set, zdict must be the same preset
+dictionary used when splitting.
+"""
+def join_segments(start, segments, zdict=None):
+    if len(segments) != start.segments:
+        raise ValueError(f"Expected {start.segments} segments, got {len(segments)}")
+    databytes = b''.join(data for seq_no, data in sorted(segments))
+    if start.flags & FLAG_COMPRESSED:
+        databytes = compression.decompress(databytes, zdict)
+    return databytes[:start.length.value]
+
+"""
+Grabs the full checklist_data as a string, generates the MsgChecklistUpdateStart header message and the MsgChecklistUpdateSegment messages
+If zdict is given, the payload is compressed with it as preset dictionary (see compression.build_zdict()).
+"""
+def checklist_splitter(checklist_data, checklist_version, zdict=None):
+    databytes = json.dumps(checklist_data).encode()
+    flags = 0
+    payload = databytes
+    if zdict is not None:
+        flags |= FLAG_COMPRESSED
+        payload = compression.compress(databytes, zdict)
+    segments = split_segments(payload, fc.FieldChecklistSegment.SIZE)
 
     output = []
-    output.append(MsgChecklistUpdateStart({'segments': len(segments), 'checklist_version': checklist_version, 'length': len(databytes)}))
+    output.append(MsgChecklistUpdateStart({'segments': len(segments), 'checklist_version': checklist_version, 'length': len(databytes), 'flags': flags}))
     for seq_no, segment in enumerate(segments):
         output.append(MsgChecklistUpdateSegment({'checklist_version': checklist_version, 'seq_no': seq_no, 'segment': segment}))
     return output
 
+"""
+Receive side of checklist_splitter(). Returns the checklist_data.
+"""
+def checklist_joiner(start, segments, zdict=None):
+    return json.loads(join_segments(start, [(s.seq_no, s.segment.value) for s in segments], zdict))
+
 """
 Grabs a complete user question payload as string, and generates header and segment messages to be transmitted via the comms link
+If zdict is given, the payload is compressed with it as preset dictionary (see compression.build_zdict()).
 """
-def user_question_splitter(user_question_data, question_id):
-    segments = []
+def user_question_splitter(user_question_data, question_id, zdict=None):
     databytes = json.dumps(user_question_data).encode()
-    it = iter(databytes)
-    while True:
-        segment = islice(it, fc.FieldUserQuestionSegment.SIZE)
-        if len(segment) < fc.FieldUserQuestionSegment.SIZE:
-            segment += b'\0' * (fc.FieldUserQuestionSegment.SIZE - len(segment))
-            segments.append(segment)
-            break
-        else:
-            segments.append(segment)
+    flags = 0
+    payload = databytes
+    if zdict is not None:
+        flags |= FLAG_COMPRESSED
+        payload = compression.compress(databytes, zdict)
+    segments = split_segments(payload, fc.FieldUserQuestionSegment.SIZE)
 
     output = []
-    output.append(MsgUserQuestionStart({'segments': len(segments), 'question_id': question_id, 'length': len(databytes)}))
+    output.append(MsgUserQuestionStart({'segments': len(segments), 'question_id': question_id, 'length': len(databytes), 'flags': flags}))
     for seq_no, segment in enumerate(segments):
         output.append(MsgUserQuestionSegment({'question_id': question_id, 'seq_no': seq_no, 'data': segment}))
     return output
+
+"""
+Receive side of user_question_splitter(). Returns the user question data.
+"""
+def user_question_joiner(start, segments, zdict=None):
+    return json.loads(join_segments(start, [(s.seq_no, s.data.value) for s in segments], zdict))
@@ -0,0 +1,162 @@
+import json
+import os
+import time
+
+"""
+Histogram(): HDR-style latency histogram.
+Values (microseconds) are stored in log-linear buckets: every power of two is split in 2**SUB_BUCKET_BITS
+sub-buckets, which keeps the relative error under ~6% with a fixed-size list of counters, so recording a
+value is a couple of integer operations and an index increment.
+"""
+class Histogram():
+    SUB_BUCKET_BITS = 4
+    SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+    MAX_VALUE = (1 << 32) - 1   # ~71 minutes in microseconds, larger values are clamped
+    __slots__ = ('counts', 'count', 'total', 'min', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (self.index(self.MAX_VALUE) + 1)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    @classmethod
+    def index(cls, value):
+        b = value.bit_length()
+        if b <= cls.SUB_BUCKET_BITS + 1:
+            return value
+        shift = b - cls.SUB_BUCKET_BITS - 1
+        return ((shift + 1) << cls.SUB_BUCKET_BITS) + (value >> shift) - cls.SUB_BUCKETS
+
+    @classmethod
+    def lower_bound(cls, index):
+        if index < 2 * cls.SUB_BUCKETS:
+            return index
+        shift = (index >> cls.SUB_BUCKET_BITS) - 1
+        return ((index & (cls.SUB_BUCKETS - 1)) + cls.SUB_BUCKETS) << shift
+
+    def record(self, value):
+        value = min(int(value), self.MAX_VALUE)
+        self.counts[self.index(value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        if self.min is None or value < self.min:
+            self.min = value
+
+    def percentile(self, p):
+        if self.count == 0:
+            return 0
+        target = max(1, round(self.count * p / 100))
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                return min(self.lower_bound(i), self.max)
+        return self.max
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'min': self.min or 0,
+            'max': self.max,
+            'mean': self.total / self.count if self.count else 0,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'p999': self.percentile(99.9),
+            'buckets': {i: n for i, n in enumerate(self.counts) if n}
+        }
+
+"""
+TypeStats(): Counters kept for each message type.
+"""
+class TypeStats():
+    __slots__ = ('in_count', 'in_bytes', 'out_count', 'out_bytes', 'decode', 'encode', 'dispatch')
+
+    def __init__(self):
+        self.in_count = 0
+        self.in_bytes = 0
+        self.out_count = 0
+        self.out_bytes = 0
+        self.decode = Histogram()
+        self.encode = Histogram()
+        self.dispatch = Histogram()
+
+    def as_dict(self):
+        return {
+            'in_count': self.in_count,
+            'in_bytes': self.in_bytes,
+            'out_count': self.out_count,
+            'out_bytes': self.out_bytes,
+            'decode_us': self.decode.as_dict(),
+            'encode_us': self.encode.as_dict(),
+            'dispatch_us': self.dispatch.as_dict()
+        }
+
+"""
+Metrics(): Per-process metric registry.
+Every process (Main and the UserTerminal subprocess) keeps its own instance, the subprocess periodically
+ships its snapshot to Main through the manager queue so both can be read from a single place.
+Timings are taken with time.perf_counter_ns() and recorded in microseconds.
+"""
+class Metrics():
+    def __init__(self):
+        self.types = {}
+        self.malformed = 0
+        self.gauges = {}
+        self.started = time.time()
+
+    def _type(self, name):
+        try:
+            return self.types[name]
+        except KeyError:
+            stats = self.types[name] = TypeStats()
+            return stats
+
+    def inbound(self, name, nbytes, decode_ns):
+        stats = self._type(name)
+        stats.in_count += 1
+        stats.in_bytes += nbytes
+        stats.decode.record(decode_ns // 1000)
+
+    def outbound(self, name, nbytes, encode_ns):
+        stats = self._type(name)
+        stats.out_count += 1
+        stats.out_bytes += nbytes
+        stats.encode.record(encode_ns // 1000)
+
+    def dispatched(self, name, dispatch_ns):
+        self._type(name).dispatch.record(dispatch_ns // 1000)
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def snapshot(self):
+        return {
+            'pid': os.getpid(),
+            'uptime': time.time() - self.started,
+            'malformed': self.malformed,
+            'gauges': dict(self.gauges),
+            'types': {name: stats.as_dict() for name, stats in self.types.items()}
+        }
+
+"""
+Reads the size of a multiprocessing queue. Returns None on platforms where qsize() is not implemented (macOS).
+"""
+def queue_depth(q):
+    try:
+        return q.qsize()
+    except NotImplementedError:
+        return None
+
+"""
+Writes a stats dictionary to filename as JSON. The file is replaced atomically so readers never see a partial dump.
+"""
+def dump_stats(stats, filename):
+    tmpname = f"{filename}.tmp"
+    with open(tmpname, 'w') as fh:
+        json.dump(stats, fh)
+    os.replace(tmpname, filename)
@@ -0,0 +1,35 @@
+import cProfile
+import os
+import time
+
+"""
+Profiler(): cProfile wrapper for one process.
+Each call to stop() writes the collected profile to <directory>/<name>-<pid>-<timestamp>-<window>.prof and resets it,
+so several profiling windows can be captured from a long-running instance. The files can be read with pstats
+or any cProfile viewer (snakeviz, gprof2dot...).
+"""
+class Profiler():
+    def __init__(self, name, directory='.'):
+        self.name = name
+        self.directory = directory
+        self._profile = None
+        self._windows = 0
+
+    @property
+    def running(self):
+        return self._profile is not None
+
+    def start(self):
+        if self._profile is None:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+
+    def stop(self):
+        if self._profile is None:
+            return None
+        self._profile.disable()
+        self._windows += 1
+        filename = os.path.join(self.directory, f"{self.name}-{os.getpid()}-{time.strftime('%Y%m%d%H%M%S')}-{self._windows}.prof")
+        self._profile.dump_stats(filename)
+        self._profile = None
+        return filename
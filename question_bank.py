@@ -0,0 +1,134 @@
+import json
+import random
+from array import array
+
+WIRE_KEYS = ('question', 'expected', 'critical')
+ANY_VEHICLE = '*'
+
+"""
+AliasTable(): Walker/Vose alias table for O(1) weighted sampling over a fixed set of items.
+Built in O(n) from the weights; each draw takes one random index and one coin flip.
+"""
+class AliasTable():
+    def __init__(self, items, weights):
+        n = len(items)
+        self.items = array('I', items)
+        self._prob = array('d', [0.0]) * n
+        self._alias = array('I', [0]) * n
+        total = sum(weights)
+        scaled = [w * n / total for w in weights]
+        small = [i for i, w in enumerate(scaled) if w < 1]
+        large = [i for i, w in enumerate(scaled) if w >= 1]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self._prob[s] = scaled[s]
+            self._alias[s] = l
+            scaled[l] -= 1 - scaled[s]
+            (small if scaled[l] < 1 else large).append(l)
+        for i in small + large:
+            self._prob[i] = 1.0
+
+    def __len__(self):
+        return len(self.items)
+
+    def sample(self, rng):
+        i = int(rng.random() * len(self.items))
+        return self.items[i] if rng.random() < self._prob[i] else self.items[self._alias[i]]
+
+"""
+QuestionBank(): Checklist questions grouped by vehicle type and category, with precomputed sampling tables.
+Each question is a dictionary with the wire keys (question, expected, critical) plus optional:
+    vehicle_type    Vehicle type it applies to, or a list of them. Defaults to every type ('*').
+    category        Category name. Defaults to 'general'.
+    weight          Relative sampling weight. Defaults to 1.
+    mandatory       If true, the question is included in every checklist for its vehicle types.
+Only the wire keys are kept in self.questions, which is what's sent to the terminals.
+Alias tables are built once at load time for every (vehicle type, category) pair and for every vehicle type as
+a whole, so drawing a checklist takes time proportional to its size, not to the size of the bank.
+"""
+class QuestionBank():
+    MAX_ATTEMPTS_FACTOR = 32    # Rejection sampling attempts per question before falling back to a linear draw
+
+    def __init__(self, questions):
+        self.questions = tuple({k: q[k] for k in WIRE_KEYS} for q in questions)
+        self._weights = array('d', (q.get('weight', 1) for q in questions))
+
+        vehicle_types = {ANY_VEHICLE}
+        for q in questions:
+            vt = q.get('vehicle_type', ANY_VEHICLE)
+            vehicle_types.update(vt if isinstance(vt, list) else [vt])
+
+        self._mandatory = {}
+        self._tables = {}
+        for vehicle_type in vehicle_types:
+            mandatory = []
+            by_category = {}
+            for i, q in enumerate(questions):
+                vt = q.get('vehicle_type', ANY_VEHICLE)
+                if vt != ANY_VEHICLE and vehicle_type != ANY_VEHICLE and vehicle_type not in (vt if isinstance(vt, list) else [vt]):
+                    continue
+                if q.get('mandatory', False):
+                    mandatory.append(i)
+                else:
+                    by_category.setdefault(q.get('category', 'general'), []).append(i)
+            self._mandatory[vehicle_type] = tuple(mandatory)
+            everything = [i for items in by_category.values() for i in items]
+            tables = {category: self._table(items) for category, items in by_category.items()}
+            tables[None] = self._table(everything)
+            self._tables[vehicle_type] = tables
+
+    def _table(self, items):
+        return AliasTable(items, [self._weights[i] for i in items]) if items else None
+
+    """
+    Builds the bank from the configuration: from the JSON file named by 'question_bank' if set, otherwise from
+    the 'checklist_questions' list.
+    """
+    @classmethod
+    def from_config(cls, cfg):
+        if 'question_bank' in cfg:
+            with open(cfg['question_bank']) as fh:
+                questions = json.load(fh)
+        else:
+            questions = cfg['checklist_questions']
+        return cls(questions)
+
+    def __len__(self):
+        return len(self.questions)
+
+    """
+    Draws the question indices of a new checklist: the mandatory questions of the vehicle type first, then
+    weighted picks without repetition. categories optionally maps category names to the number of questions to
+    pick from each one; the rest up to num_questions is picked from the whole bank. rng is a random.Random
+    instance (or a seed), so draws can be reproduced.
+    """
+    def draw(self, num_questions, rng=None, vehicle_type=ANY_VEHICLE, categories=None):
+        if not isinstance(rng, random.Random):
+            rng = random.Random(rng)
+        tables = self._tables.get(vehicle_type, self._tables[ANY_VEHICLE])
+        picked = list(self._mandatory.get(vehicle_type, self._mandatory[ANY_VEHICLE]))[:num_questions]
+        seen = set(picked)
+        for category, count in (categories or {}).items():
+            self._draw_from(tables.get(category), min(count, num_questions - len(picked)), rng, picked, seen)
+        self._draw_from(tables[None], num_questions - len(picked), rng, picked, seen)
+        return picked
+
+    def _draw_from(self, table, count, rng, picked, seen):
+        if table is None or count <= 0:
+            return
+        target = len(picked) + count
+        attempts = count * self.MAX_ATTEMPTS_FACTOR
+        while len(picked) < target and attempts:
+            attempts -= 1
+            i = table.sample(rng)
+            if i not in seen:
+                seen.add(i)
+                picked.append(i)
+        if len(picked) < target:
+            # Table nearly exhausted (or very skewed weights): finish with a linear weighted draw
+            remaining = [i for i in table.items if i not in seen]
+            while remaining and len(picked) < target:
+                i = rng.choices(remaining, [self._weights[j] for j in remaining])[0]
+                remaining.remove(i)
+                seen.add(i)
+                picked.append(i)
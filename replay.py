@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import queue
+from time import sleep, perf_counter, perf_counter_ns
+import message_codecs as mc
+from framelog import FrameLog, FrameLogReader, DIR_IN, DIR_OUT, frame_ids
+from metrics import Metrics, Histogram
+from clock import VirtualClock
+from linkquality import LinkQuality
+from admission import Admission, CRITICAL
+
+"""
+LocalTerminal(): In-process stand-in for UserTerminal, used to drive Main without a Bluetooth connection.
+Frames given to inject() go through the same duplicate filter, admission control (cfg_admission) and decoding as
+in UserTerminal (see admission.Admission.receive()), and end up in mgr_q, the queue Main reads from, as coming from
+connection conn. Frames held back by admission control are moved to mgr_q by pump(), which the driving loop calls
+between passes of Main. clock is the clock of the rate limits (perf_counter() time without it). Messages sent by
+Main are encoded and kept in sent as (perf_counter() time, name, data, conn), unless keep_sent is False (long
+simulations), in which case they're only counted in metrics. With cfg_framelog, frames are logged as UserTerminal
+logs them, timestamped by clock.
+"""
+class LocalTerminal():
+    def __init__(self, keep_sent=True, cfg_admission=None, clock=None, cfg_framelog=None):
+        self.mgr_q = queue.Queue()
+        self._proc_q = queue.Queue()    # Only there so Main can report its depth
+        self.metrics = Metrics()
+        self.link = LinkQuality()
+        self.admission = Admission(cfg_admission, self.mgr_q)
+        self.clock = clock
+        self.framelog = FrameLog.from_config(cfg_framelog, clock)
+        self.buckets = {}
+        self.keep_sent = keep_sent
+        self.sent = []
+
+    def _now(self):
+        return self.clock.monotonic() if self.clock is not None else perf_counter()
+
+    def _bucket(self, conn):
+        try:
+            return self.buckets[conn]
+        except KeyError:
+            bucket = self.buckets[conn] = self.admission.bucket(self._now())
+            return bucket
+
+    """
+    Tells Main a terminal connected as connection conn, as UserTerminal does when it accepts one.
+    """
+    def connect(self, conn):
+        self._bucket(conn)
+        self.admission.put(CRITICAL, {'type': 'user_connected', 'conn': conn}, self._now())
+        self.pump()
+
+    def inject(self, pkt, conn=0):
+        t0 = perf_counter_ns()
+        if self.framelog is not None:
+            log_frame = lambda value: self.framelog.append(pkt, *frame_ids(value), DIR_IN, conn=conn)
+        else:
+            log_frame = None
+        level, msg, error = self.admission.receive(pkt, self.link, self._bucket(conn), self._now(), log_frame)
+        if error is not None:
+            self.metrics.malformed += 1
+        if level is None:
+            return
+        if msg is None:
+            self.admission.put(level, {'type': 'user_received_malformed', 'msg': pkt, 'error': error, 'conn': conn}, self._now())
+        else:
+            self.metrics.inbound(msg.NAME, len(pkt), perf_counter_ns() - t0)
+            self.admission.put(level, {'type': 'user_received', 'msg': msg, 'trace': None, 'conn': conn}, self._now())
+        self.pump()
+
+    """
+    Moves the frames waiting in admission control to mgr_q, as far as there's room. Returns the number moved.
+    """
+    def pump(self):
+        return self.admission.forward(self._now())
+
+    """
+    Metrics in the form UserTerminal reports them.
+    """
+    def stats(self):
+        stats = self.metrics.snapshot()
+        stats['link'] = self.link.stats()
+        stats['admission'] = self.admission.stats()
+        return stats
+
+    def send(self, msg, trace=None, name=None, conn=None):
+        name = name or getattr(msg, 'NAME', 'raw')
+        t0 = perf_counter_ns()
+        data = msg if isinstance(msg, bytes) else msg.as_json().encode()
+        self.metrics.outbound(name, len(data), perf_counter_ns() - t0)
+        if self.framelog is not None and self.framelog.capture:
+            # Messages without a connection go to every connection seen so far
+            for c in ([conn] if conn is not None else list(self.buckets)):
+                self.framelog.append(data, 0, mc.MSG_TYPES.get(name, 0), DIR_OUT, conn=c)
+        if self.keep_sent:
+            self.sent.append((perf_counter(), name, data, conn))
+
+    def profile(self, action):
+        pass
+
+    def stop(self, timeout=None):
+        if self.framelog is not None:
+            self.framelog.close()
+
+# Inbound request types and the outbound types answering them, as type codes. Response latencies only pair these,
+# other outbound frames (reports, time probes, broadcasts) don't answer anything.
+ANSWERS = {mc.MSG_TYPES[request]: {mc.MSG_TYPES[answer] for answer in answers} for request, answers in (
+    (mc.MsgLoginRequest.NAME, (mc.MsgLoginResponse.NAME,)),
+    (mc.MsgChecklistVersionNotification.NAME, (mc.MsgChecklistUpdate.NAME, mc.MsgChecklistUpdateStart.NAME, mc.MsgChecklistDelta.NAME)),
+    (mc.MsgTimeRequest.NAME, (mc.MsgTimeSet.NAME,))
+)}
+
+"""
+Loads a capture as a list of (timestamp, direction, conn, msgtype, payload), in recording order.
+"""
+def load_capture(directory, t0=None, t1=None):
+    return [(ts, direction, conn, msgtype, bytes(payload)) for ts, tagid, conn, msgtype, direction, payload in FrameLogReader(directory).frames(t0, t1)]
+
+"""
+Response latency of a recording: for every request (see ANSWERS), the time from the frame to the first answer on
+the same connection, if it comes before the next request of the connection (microseconds).
+"""
+def recorded_latency(frames):
+    hist = Histogram()
+    pending = {}    # conn -> (timestamp, answer types) of its request waiting for an answer
+    for ts, direction, conn, msgtype, payload in frames:
+        if direction == DIR_IN:
+            if msgtype in ANSWERS:
+                pending[conn] = (ts, ANSWERS[msgtype])
+        elif conn in pending and msgtype in pending[conn][1]:
+            hist.record((ts - pending.pop(conn)[0]) * 1e6)
+    return hist
+
+"""
+Feeds the inbound frames of a capture to main through terminal (a LocalTerminal).
+speed is the replay speed relative to the recording (1 = recorded speed, 10 = ten times faster), or None to
+go as fast as possible. With a virtual clock (the VirtualClock main runs on), frames go as fast as possible but
+main sees them arrive at their recorded times, and its timers run in between as they would have during the
+recording. Frames are injected on their recorded connections, each connected (terminal.connect()) before its first
+frame, and every frame is processed before the next one is injected. Returns the wall time taken and histograms of the response latency (for requests that got an answer, as
+in recorded_latency) and of the processing time of every frame, both in microseconds.
+"""
+def replay(main, terminal, frames, speed=None, clock=None):
+    inbound = [(ts, conn, msgtype, payload) for ts, direction, conn, msgtype, payload in frames if direction == DIR_IN]
+    latency = Histogram()
+    processing = Histogram()
+    if not inbound:
+        return 0, latency, processing
+
+    first_ts = inbound[0][0]
+    connected = set()
+    start = perf_counter()
+    for ts, conn, msgtype, payload in inbound:
+        if clock is not None:
+            clock.advance_to(ts - first_ts)
+        elif speed is not None:
+            delay = start + (ts - first_ts) / speed - perf_counter()
+            if delay > 0:
+                sleep(delay)
+        if conn not in connected:
+            connected.add(conn)
+            terminal.connect(conn)
+            while terminal.pump() or main.single_pass():
+                pass
+        n_sent = len(terminal.sent)
+        t = perf_counter()
+        terminal.inject(payload, conn)
+        while terminal.pump() or main.single_pass():
+            pass
+        end = perf_counter()
+        processing.record((end - t) * 1e6)
+        answers = ANSWERS.get(msgtype, ())
+        for sent_t, name, data, sent_conn in terminal.sent[n_sent:]:
+            if sent_conn == conn and mc.MSG_TYPES.get(name) in answers:
+                latency.record((sent_t - t) * 1e6)
+                break
+    return perf_counter() - start, latency, processing
+
+def print_report(frames, elapsed, latency, processing, recorded):
+    inbound = sum(1 for f in frames if f[1] == DIR_IN)
+    duration = frames[-1][0] - frames[0][0] if frames else 0
+    print(f"{'':<22} {'recording':>12} {'replay':>12}")
+    print(f"{'inbound frames':<22} {inbound:>12} {processing.count:>12}")
+    print(f"{'duration s':<22} {duration:>12.3f} {elapsed:>12.3f}")
+    print(f"{'frames/s':<22} {inbound / duration if duration else 0:>12.1f} {processing.count / elapsed if elapsed else 0:>12.1f}")
+    for p in (50, 90, 99):
+        print(f"{f'response p{p} us':<22} {recorded.percentile(p):>12} {latency.percentile(p):>12}")
+    print(f"{'response max us':<22} {recorded.max:>12} {latency.max:>12}")
+    print(f"{'processing p50 us':<22} {'':>12} {processing.percentile(50):>12}")
+    print(f"{'processing p99 us':<22} {'':>12} {processing.percentile(99):>12}")
+
+if __name__ == '__main__':
+    from main import Main
+
+    p = argparse.ArgumentParser(description="Replay a frame capture (main.py --capture) through Main")
+    p.add_argument('capture', help="Capture directory")
+    p.add_argument('--config', '-c', help="Configuration file", default="/etc/tag-dummy.json")
+    p.add_argument('--loglevel', '-l', choices=['debug', 'info', 'warning', 'error', 'critical'], default='warning', help="Logging level")
+    g = p.add_mutually_exclusive_group()
+    g.add_argument('--speed', '-s', type=float, default=1.0, help="Replay speed relative to the recording (default 1)")
+    g.add_argument('--fast', '-f', action='store_true', help="Replay as fast as possible")
+    g.add_argument('--virtual', '-v', action='store_true', help="Replay as fast as possible on a virtual clock following the recorded times")
+    p.add_argument('--start', type=float, help="Start timestamp (UNIX time)")
+    p.add_argument('--end', type=float, help="End timestamp (UNIX time)")
+    p.add_argument('--stats', action='store_true', help="Print Main's metrics after the replay")
+    args = p.parse_args()
+
+    frames = load_capture(args.capture, args.start, args.end)
+    clock = VirtualClock(frames[0][0] if frames else 0.0) if args.virtual else None
+    with open(args.config) as fh:
+        cfg_admission = json.load(fh).get('admission')
+    terminal = LocalTerminal(cfg_admission=cfg_admission, clock=clock)
+    with Main(['--config', args.config, '--loglevel', args.loglevel], terminal=terminal, keyboard=False, clock=clock) as main:
+        # Answers to the startup checklist don't belong to any replayed frame
+        terminal.sent.clear()
+        elapsed, latency, processing = replay(main, terminal, frames, None if args.fast or args.virtual else args.speed, clock)
+        print_report(frames, elapsed, latency, processing, recorded_latency(frames))
+        if args.stats:
+            main.ut_stats = terminal.stats()
+            print(json.dumps(main.stats(), indent=2))
@@ -0,0 +1,130 @@
+import math
+import random
+import message_codecs as mc
+from timerwheel import TimerWheel
+
+"""
+TagMotion(): Simulated movement and report settings of one tag.
+Position is in UWB coordinates (metres); heading in radians.
+"""
+class TagMotion():
+    __slots__ = ('tag', 'x', 'y', 'heading', 'frame_counter', 'report_rate', 'crash_sens', 'timer')
+
+    def __init__(self, tag, x, y, heading, report_rate, crash_sens):
+        self.tag = tag
+        self.x = x
+        self.y = y
+        self.heading = heading
+        self.frame_counter = 0
+        self.report_rate = report_rate
+        self.crash_sens = crash_sens
+        self.timer = None
+
+"""
+ReportGenerator(): Emits synthetic MsgVehicleReport and MsgImpactReport messages for every simulated tag.
+Every tag wanders around the area at a constant speed and sends a vehicle report report_rate times per second
+(0 stops them), with an incrementing frame counter. Along with each report there's a chance (impact_probability)
+of an impact with a random severity; it's sent as a MsgImpactReport if its severity reaches the tag's crash_sens.
+Both settings come from the configuration and change per tag with MsgTagConfig (see configure()).
+
+Reports are scheduled on a TimerWheel advanced by a clock timer every tick, so the cost per report doesn't depend
+on the number of tags. send(msg, tag) is called for every message generated.
+
+cfg is the 'reports' section of the configuration:
+    report_rate         Reports per second of every tag until it gets a MsgTagConfig (default 0)
+    crash_sens          Minimum severity of the impacts reported (default 128)
+    impact_probability  Chance of an impact per vehicle report (default 0.01)
+    speed               Speed of the tags in metres per second (default 2)
+    area                Width and height of the UWB area in metres (default [100, 50])
+    origin              GPS [lat, lon] of the UWB origin (default [0, 0])
+    tick                Timer wheel tick in seconds (default 0.01)
+    seed                Seed of the random generator, for reproducible runs
+"""
+class ReportGenerator():
+    METRES_PER_DEGREE = 111320.0
+
+    def __init__(self, cfg, tags, clock, send):
+        self.cfg = cfg
+        self.clock = clock
+        self.send = send
+        self.rng = random.Random(cfg.get('seed'))
+        self.speed = cfg.get('speed', 2.0)
+        self.width, self.height = cfg.get('area', [100, 50])
+        self.origin_lat, self.origin_lon = cfg.get('origin', [0.0, 0.0])
+        self.impact_probability = cfg.get('impact_probability', 0.01)
+        self.wheel = TimerWheel(cfg.get('tick', 0.01), clock.monotonic())
+        self.generated = 0
+        self.impacts = 0
+        self.motions = {}
+        for tag in tags:
+            motion = TagMotion(tag, self.rng.uniform(0, self.width), self.rng.uniform(0, self.height),
+                self.rng.uniform(0, 2 * math.pi), cfg.get('report_rate', 0), cfg.get('crash_sens', 128))
+            self.motions[tag.tagid] = motion
+            if motion.report_rate:
+                # Random phase, so the tags don't all report on the same tick
+                motion.timer = self.wheel.call_later(self.rng.uniform(0, 1 / motion.report_rate), self._report, motion)
+        self.clock.call_later(self.wheel.tick, self._tick)
+
+    def _tick(self):
+        self.wheel.advance(self.clock.monotonic())
+        self.clock.call_later(self.wheel.tick, self._tick)
+
+    """
+    Applies a MsgTagConfig to a tag. A new report rate takes effect right away: the next report comes one period
+    of the new rate from now.
+    """
+    def configure(self, tag, report_rate, crash_sens):
+        motion = self.motions[tag.tagid]
+        motion.crash_sens = crash_sens
+        if report_rate != motion.report_rate:
+            motion.report_rate = report_rate
+            if motion.timer is not None:
+                motion.timer.cancel()
+                motion.timer = None
+            if report_rate:
+                motion.timer = self.wheel.call_later(1 / report_rate, self._report, motion)
+
+    def _report(self, motion):
+        period = 1 / motion.report_rate
+        motion.timer = self.wheel.call_later(period, self._report, motion)
+
+        # Move, turning a bit at random and bouncing off the edges of the area
+        motion.heading += self.rng.gauss(0, 0.2)
+        x = motion.x + self.speed * period * math.cos(motion.heading)
+        y = motion.y + self.speed * period * math.sin(motion.heading)
+        if not 0 <= x <= self.width:
+            motion.heading = math.pi - motion.heading
+            x = min(max(x, 0), self.width)
+        if not 0 <= y <= self.height:
+            motion.heading = -motion.heading
+            y = min(max(y, 0), self.height)
+        motion.x, motion.y = x, y
+        motion.frame_counter = (motion.frame_counter + 1) & 0xFFFF
+
+        tag = motion.tag
+        if tag.conn is None:
+            return
+        lat = self.origin_lat + y / self.METRES_PER_DEGREE
+        lon = self.origin_lon + x / (self.METRES_PER_DEGREE * math.cos(math.radians(self.origin_lat)))
+        self.send(mc.MsgVehicleReport({
+            'tagid': tag.tagid,
+            'frame_counter': motion.frame_counter,
+            'uwbpos': {'xpos': x, 'ypos': y, 'zpos': 0.0},
+            'gpspos': {'lat': lat, 'lon': lon}
+        }), tag)
+        self.generated += 1
+
+        if self.rng.random() < self.impact_probability:
+            severity = self.rng.randint(1, 255)
+            if severity >= motion.crash_sens:
+                # Direction in 1/256 of a turn
+                direction = int(self.rng.uniform(0, 256)) & 0xFF
+                self.send(mc.MsgImpactReport({'tagid': tag.tagid, 'severity': severity, 'accel_direction': direction}), tag)
+                self.impacts += 1
+
+    def stats(self):
+        return {
+            'vehicle_reports': self.generated,
+            'impact_reports': self.impacts,
+            'scheduled': self.wheel.pending
+        }
@@ -0,0 +1,89 @@
+from collections import deque
+
+"""
+TagState(): State of one simulated tag.
+checklist_version is the checklist version the tag's terminal has (0 if unknown), uid the logged in user (None
+if nobody is) and conn the id of the terminal connection serving the tag (None if not connected).
+Kept in __slots__ so thousands of tags take little memory (about 150 bytes per tag, lookup tables included).
+"""
+class TagState():
+    __slots__ = ('tagid', 'conn', 'checklist_version', 'uid', 'blocked')
+
+    def __init__(self, tagid):
+        self.tagid = tagid
+        self.conn = None
+        self.checklist_version = 0
+        self.uid = None
+        self.blocked = False
+
+    def as_dict(self):
+        return {
+            'tagid': self.tagid,
+            'conn': self.conn,
+            'checklist_version': self.checklist_version,
+            'uid': self.uid,
+            'blocked': self.blocked
+        }
+
+"""
+TagFarm(): The set of tags simulated by the process.
+Every terminal connection is served by its own tag: a connection gets the first free tag when it connects (or
+sends its first frame), and the tag is freed when it disconnects.
+"""
+class TagFarm():
+    def __init__(self, tagids):
+        self.tags = [TagState(tagid) for tagid in tagids]
+        self.by_tagid = {tag.tagid: tag for tag in self.tags}
+        self.by_conn = {}
+        self._free = deque(self.tags)
+
+    """
+    Builds the farm from the configuration. 'tags' is either a list of tagids or a number of tags, numbered
+    consecutively from 'tagid'. Without it, the farm has the single tag 'tagid'.
+    """
+    @classmethod
+    def from_config(cls, cfg):
+        tags = cfg.get('tags', 1)
+        if isinstance(tags, list):
+            return cls(tags)
+        return cls(range(cfg['tagid'], cfg['tagid'] + tags))
+
+    def __len__(self):
+        return len(self.tags)
+
+    def __iter__(self):
+        return iter(self.tags)
+
+    """
+    Returns the tag served by connection conn, assigning it a free one if it has none. Returns None if all the
+    tags are taken.
+    """
+    def attach(self, conn):
+        tag = self.by_conn.get(conn)
+        if tag is None and self._free:
+            tag = self._free.popleft()
+            tag.conn = conn
+            self.by_conn[conn] = tag
+        return tag
+
+    """
+    Frees the tag served by connection conn. The new terminal of the tag will have to report its checklist version.
+    """
+    def detach(self, conn):
+        tag = self.by_conn.pop(conn, None)
+        if tag is not None:
+            tag.conn = None
+            tag.checklist_version = 0
+            self._free.append(tag)
+        return tag
+
+    def connected(self):
+        return [tag for tag in self.tags if tag.conn is not None]
+
+    def summary(self):
+        return {
+            'tags': len(self.tags),
+            'connected': len(self.by_conn),
+            'logged_in': sum(1 for tag in self.tags if tag.uid is not None),
+            'blocked': sum(1 for tag in self.tags if tag.blocked)
+        }
@@ -0,0 +1,105 @@
+from array import array
+
+"""
+TagTrack(): Fixed-capacity ring of position samples for one tag, stored column-wise in typed arrays.
+Appending a sample writes one value per column at the head position, no objects are created per sample.
+Samples are expected in non-decreasing timestamp order (they're stamped on arrival), which lets time window
+queries use binary search.
+"""
+class TagTrack():
+    COLUMNS = (('ts', 'd'), ('frame', 'H'), ('x', 'd'), ('y', 'd'), ('z', 'd'), ('lat', 'd'), ('lon', 'd'))
+    __slots__ = ('capacity', 'count', '_head') + tuple(name for name, typecode in COLUMNS)
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.count = 0
+        self._head = 0  # Position where the next sample goes
+        for name, typecode in self.COLUMNS:
+            setattr(self, name, array(typecode, bytes(array(typecode).itemsize * capacity)))
+
+    def append(self, ts, frame, x, y, z, lat, lon):
+        i = self._head
+        self.ts[i] = ts
+        self.frame[i] = frame
+        self.x[i] = x
+        self.y[i] = y
+        self.z[i] = z
+        self.lat[i] = lat
+        self.lon[i] = lon
+        self._head = (i + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    def _pos(self, n):
+        # Ring position of the n-th oldest sample
+        return (self._head - self.count + n) % self.capacity
+
+    def sample(self, n):
+        i = self._pos(n)
+        return {
+            'ts': self.ts[i],
+            'frame_counter': self.frame[i],
+            'uwbpos': {'xpos': self.x[i], 'ypos': self.y[i], 'zpos': self.z[i]},
+            'gpspos': {'lat': self.lat[i], 'lon': self.lon[i]}
+        }
+
+    def latest(self):
+        return self.sample(self.count - 1) if self.count else None
+
+    def _bisect(self, t):
+        # Index (oldest = 0) of the first sample with ts >= t
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.ts[self._pos(mid)] < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def window(self, t0, t1):
+        return [self.sample(n) for n in range(self._bisect(t0), self._bisect(t1))]
+
+    def downsample(self, t0, t1, step):
+        # One sample (the first one) per step seconds between t0 and t1
+        out = []
+        n, end = self._bisect(t0), self._bisect(t1)
+        while n < end:
+            out.append(self.sample(n))
+            n = max(n + 1, self._bisect(self.ts[self._pos(n)] + step))
+        return out
+
+"""
+TelemetryStore(): Position history per tag, built from MsgVehicleReport messages.
+Every tag gets a TagTrack of the same capacity, so memory is bounded per tag (about 52 bytes per sample).
+"""
+class TelemetryStore():
+    CAPACITY = 3600
+
+    def __init__(self, capacity=CAPACITY):
+        self.capacity = capacity
+        self.tracks = {}
+
+    def append(self, tagid, ts, frame, x, y, z, lat, lon):
+        try:
+            track = self.tracks[tagid]
+        except KeyError:
+            track = self.tracks[tagid] = TagTrack(self.capacity)
+        track.append(ts, frame, x, y, z, lat, lon)
+
+    def add_report(self, msg, ts):
+        uwb = msg.uwbpos.value
+        gps = msg.gpspos.value
+        self.append(msg.tagid.value, ts, msg.frame_counter.value, uwb['xpos'], uwb['ypos'], uwb['zpos'], gps['lat'], gps['lon'])
+
+    def latest(self, tagid):
+        track = self.tracks.get(tagid)
+        return track.latest() if track else None
+
+    def window(self, tagid, t0, t1):
+        track = self.tracks.get(tagid)
+        return track.window(t0, t1) if track else []
+
+    def trajectory(self, tagid, t0, t1, step):
+        track = self.tracks.get(tagid)
+        return track.downsample(t0, t1, step) if track else []
@@ -0,0 +1,87 @@
+"""
+WheelTimer(): Handle of a timer set in a TimerWheel.
+"""
+class WheelTimer():
+    __slots__ = ('expires', 'fn', 'args', 'cancelled')
+
+    def __init__(self, expires, fn, args):
+        self.expires = expires
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+"""
+TimerWheel(): Hierarchical timing wheel.
+Time is counted in ticks of tick seconds. There are LEVELS wheels of SLOTS slots each; level L holds the timers
+whose expiry tick shares every digit above L (in base SLOTS) with the current tick, in the slot of its digit L.
+Scheduling and cancelling take constant time whatever the number of timers. When the current tick reaches a slot
+of an upper level, its timers are moved down, each timer being moved at most LEVELS - 1 times.
+With 256 slots and 4 levels, timers can be set up to 2**32 ticks ahead (about 500 days with 10 ms ticks).
+"""
+class TimerWheel():
+    SLOT_BITS = 8
+    SLOTS = 1 << SLOT_BITS
+    LEVELS = 4
+
+    def __init__(self, tick, now=0.0):
+        self.tick = tick
+        self.current = int(now / tick)
+        self._wheels = [[[] for _ in range(self.SLOTS)] for _ in range(self.LEVELS)]
+        self.pending = 0    # Timers in the wheel, cancelled ones included until they're dropped
+
+    def _insert(self, timer):
+        diff = timer.expires ^ self.current
+        level = 0
+        while diff >> (self.SLOT_BITS * (level + 1)) and level < self.LEVELS - 1:
+            level += 1
+        slot = (timer.expires >> (self.SLOT_BITS * level)) & (self.SLOTS - 1)
+        self._wheels[level][slot].append(timer)
+
+    """
+    Calls fn(*args) delay seconds from the wheel's current time (at least one tick later). Returns the timer, which
+    can be cancelled.
+    """
+    def call_later(self, delay, fn, *args):
+        ticks = max(1, round(delay / self.tick))
+        ticks = min(ticks, (1 << (self.SLOT_BITS * self.LEVELS)) - 1)
+        timer = WheelTimer(self.current + ticks, fn, args)
+        self._insert(timer)
+        self.pending += 1
+        return timer
+
+    """
+    Moves the wheel to time now (seconds, same clock as the one it was created with), running the timers due on the
+    way in expiry order. Returns the number of timers run.
+    """
+    def advance(self, now):
+        target = int(now / self.tick)
+        count = 0
+        while self.current < target:
+            if not self.pending:
+                self.current = target
+                break
+            self.current += 1
+            # Cascade the upper levels reaching a new slot, top down
+            for level in range(self.LEVELS - 1, 0, -1):
+                if self.current & ((1 << (self.SLOT_BITS * level)) - 1):
+                    continue
+                slot = (self.current >> (self.SLOT_BITS * level)) & (self.SLOTS - 1)
+                timers = self._wheels[level][slot]
+                self._wheels[level][slot] = []
+                for timer in timers:
+                    if timer.cancelled:
+                        self.pending -= 1
+                    else:
+                        self._insert(timer)
+            slot = self.current & (self.SLOTS - 1)
+            timers = self._wheels[0][slot]
+            self._wheels[0][slot] = []
+            for timer in timers:
+                self.pending -= 1
+                if not timer.cancelled:
+                    timer.fn(*timer.args)
+                    count += 1
+        return count
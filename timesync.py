@@ -0,0 +1,158 @@
+import collections
+import math
+import message_codecs as mc
+from metrics import queue_depth
+
+"""
+LinkClock(): Round trip time and clock offset estimates of one terminal connection.
+Every answered probe gives a sample (rtt, offset). The last window samples are kept, and the estimate is the
+sample with the lowest round trip time: queueing delays only ever add to the round trip, so the fastest exchange
+is the one whose offset is least skewed by them (the NTP clock filter). jitter is the smoothed difference between
+consecutive round trips (as in RFC 3550), offset_jitter the RMS distance of the sample offsets to the estimate.
+"""
+class LinkClock():
+    __slots__ = ('samples', 'rtt', 'offset', 'jitter', 'last_rtt', 'probes', 'answers', 'lost', 'pending')
+
+    def __init__(self, window):
+        self.samples = collections.deque(maxlen=window)
+        self.rtt = None
+        self.offset = None
+        self.jitter = 0.0
+        self.last_rtt = None
+        self.probes = 0
+        self.answers = 0
+        self.lost = 0
+        self.pending = None     # (monotonic, wall clock time) the outstanding probe was sent at
+
+    def add(self, rtt, offset):
+        self.answers += 1
+        if self.last_rtt is not None:
+            self.jitter += (abs(rtt - self.last_rtt) - self.jitter) / 16
+        self.last_rtt = rtt
+        self.samples.append((rtt, offset))
+        self.rtt, self.offset = min(self.samples)
+
+    def as_dict(self):
+        return {
+            'rtt': self.rtt,
+            'offset': self.offset,
+            'jitter': self.jitter,
+            'offset_jitter': math.sqrt(sum((offset - self.offset) ** 2 for _, offset in self.samples) / len(self.samples)) if self.samples else None,
+            'rtt_mean': sum(rtt for rtt, _ in self.samples) / len(self.samples) if self.samples else None,
+            'probes': self.probes,
+            'answers': self.answers,
+            'lost': self.lost
+        }
+
+"""
+TimeSync(): Time service of the terminal connections.
+Terminals asking for the time (MsgTimeRequest) are answered with a MsgTimeSet (see answer()). In the other
+direction, every connected terminal is probed with a MsgTimeRequest every interval seconds, and its MsgTimeSet
+answer gives a round trip time and clock offset sample for the connection (see LinkClock). Probes to different
+terminals are spread over the interval, one at a time, and at most max_rate per second overall; no probe is sent
+while the manager queue (busy_q) holds more than max_queue_depth frames, so probing backs off under load.
+
+The round trip is measured from the manager process, so it includes the queueing in both processes and on the
+terminal. Timestamps on the wire are whole seconds, which limits the offset to +/-0.5 s of resolution; the
+terminal's timestamp is taken as the middle of its second. offset is the terminal clock minus ours.
+
+tags is the tagfarm.TagFarm of the connections, send(msg, conn) sends a message to one. cfg is the 'timesync'
+section of the configuration:
+    interval        Seconds between probes of each terminal, 0 disables probing (default 0: terminals have to
+                    handle MsgTimeRequest for it to be turned on)
+    max_rate        Probes per second over all terminals (default 10)
+    timeout         Seconds after which an unanswered probe is counted as lost (default 5)
+    window          Samples kept per connection for the filter (default 8)
+    max_queue_depth Manager queue depth above which probes are held back (default 100)
+"""
+class TimeSync():
+    def __init__(self, cfg, tags, clock, send, busy_q=None):
+        cfg = cfg or {}
+        self.tags = tags
+        self.clock = clock
+        self.send = send
+        self.busy_q = busy_q
+        self.interval = cfg.get('interval', 0)
+        self.max_rate = cfg.get('max_rate', 10)
+        self.timeout = cfg.get('timeout', 5)
+        self.window = cfg.get('window', 8)
+        self.max_queue_depth = cfg.get('max_queue_depth', 100)
+        self.links = {}
+        self.requests = 0
+        self.unsolicited = 0
+        self.deferred = 0
+        self._order = collections.deque()
+        if self.interval:
+            self.clock.call_later(1 / self.max_rate, self._probe)
+
+    def _link(self, conn):
+        try:
+            return self.links[conn]
+        except KeyError:
+            link = self.links[conn] = LinkClock(self.window)
+            return link
+
+    """
+    Returns the MsgTimeSet answering a MsgTimeRequest.
+    """
+    def answer(self):
+        self.requests += 1
+        return mc.MsgTimeSet({'timestamp': int(self.clock.time())})
+
+    """
+    Takes a MsgTimeSet received on connection conn as the answer to its outstanding probe.
+    """
+    def time_set(self, conn, msg):
+        link = self.links.get(conn)
+        if link is None or link.pending is None:
+            self.unsolicited += 1
+            return
+        sent, sent_wall = link.pending
+        link.pending = None
+        rtt = self.clock.monotonic() - sent
+        link.add(rtt, msg.timestamp.value + 0.5 - (sent_wall + rtt / 2))
+
+    """
+    Forgets the estimates of a connection, when it disconnects.
+    """
+    def forget(self, conn):
+        self.links.pop(conn, None)
+
+    def _probe(self):
+        # One probe per call, to the next connection in turn. The delay to the next call spreads the probes of
+        # all the connections over the interval.
+        connections = self.tags.by_conn
+        self.clock.call_later(max(self.interval / max(len(connections), 1), 1 / self.max_rate), self._probe)
+        if self.busy_q is not None and (queue_depth(self.busy_q) or 0) > self.max_queue_depth:
+            self.deferred += 1
+            return
+        while self._order or connections:
+            if not self._order:
+                self._order.extend(connections)
+            conn = self._order.popleft()
+            tag = connections.get(conn)
+            if tag is not None:
+                break
+        else:
+            return
+        link = self._link(conn)
+        now = self.clock.monotonic()
+        if link.pending is not None:
+            if now - link.pending[0] < self.timeout:
+                return
+            link.lost += 1
+        link.probes += 1
+        link.pending = (now, self.clock.time())
+        self.send(mc.MsgTimeRequest({'tagid': tag.tagid}), conn)
+
+    def stats(self):
+        links = {}
+        for conn, link in self.links.items():
+            tag = self.tags.by_conn.get(conn)
+            links[str(conn)] = dict(link.as_dict(), tagid=tag.tagid if tag is not None else None)
+        return {
+            'requests': self.requests,
+            'unsolicited': self.unsolicited,
+            'deferred': self.deferred,
+            'links': links
+        }
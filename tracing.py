@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+import argparse
+import itertools
+import json
+import os
+import random
+from metrics import Histogram
+
+"""
+Stages a message goes through. Inbound stages are taken in the UserTerminal process (recv_start to
+enqueue) and in Main (dequeue to handler_end). Outbound stages are taken in Main (outbound_enqueue) and in the
+UserTerminal process (socket_write). All timestamps come from time.monotonic(), which is shared by both
+processes, so they can be compared directly.
+"""
+STAGES = ('recv_start', 'recv_complete', 'decode_done', 'enqueue', 'dequeue', 'handler_start', 'handler_end', 'outbound_enqueue', 'socket_write')
+
+"""
+Tracer(): Samples messages and writes their stage timestamps to a trace file as JSON lines.
+Both processes append to the same file. Every record is written with a single os.write() on a file opened
+with O_APPEND, so lines from different processes never interleave.
+A record carries the correlation id of the inbound message it belongs to; outbound records caused by
+handling that message reuse the id (if a handler sends several messages, the last one is kept when merging).
+"""
+class Tracer():
+    def __init__(self, cfg_trace):
+        cfg_trace = cfg_trace or {}
+        self.sample_rate = cfg_trace.get('sample_rate', 0.0) if 'file' in cfg_trace else 0.0
+        self._filename = cfg_trace.get('file')
+        self._fd = None
+        self._ids = itertools.count()
+
+    @property
+    def enabled(self):
+        return self.sample_rate > 0
+
+    def sample(self):
+        # Returns a new correlation id if the message is picked for tracing, None otherwise
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return f"{os.getpid():x}-{next(self._ids)}"
+        return None
+
+    def write(self, record):
+        if self._fd is None:
+            # Opened lazily so each process gets its own descriptor after the fork
+            self._fd = os.open(self._filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        os.write(self._fd, (json.dumps(record) + '\n').encode())
+
+"""
+Reads a trace file and merges records sharing a correlation id.
+Returns a dictionary mapping each id to its message name and stage timestamps.
+"""
+def load_traces(filename):
+    traces = {}
+    with open(filename) as fh:
+        for line in fh:
+            record = json.loads(line)
+            trace = traces.setdefault(record['id'], {'name': None, 'stages': {}})
+            trace['name'] = trace['name'] or record.get('name')
+            trace['stages'].update(record['stages'])
+    return traces
+
+"""
+Computes per-stage latency histograms (microseconds) between consecutive stages present in each trace.
+Stages are taken in the order they happened, since outbound messages are enqueued while the handler runs.
+"""
+def stage_breakdown(traces):
+    breakdown = {}
+    for trace in traces.values():
+        stages = sorted(trace['stages'].items(), key=lambda x: x[1])
+        for (prev, t_prev), (cur, t_cur) in zip(stages, stages[1:]):
+            hist = breakdown.setdefault(f"{prev}->{cur}", Histogram())
+            hist.record(max(0, t_cur - t_prev) * 1e6)
+    return breakdown
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description="Per-stage latency breakdown of a trace file")
+    p.add_argument('tracefile')
+    args = p.parse_args()
+
+    traces = load_traces(args.tracefile)
+    print(f"{len(traces)} traces")
+    print(f"{'stage':<32} {'count':>8} {'p50 us':>10} {'p90 us':>10} {'p99 us':>10} {'max us':>10}")
+    for stage, hist in stage_breakdown(traces).items():
+        print(f"{stage:<32} {hist.count:>8} {hist.percentile(50):>10} {hist.percentile(90):>10} {hist.percentile(99):>10} {hist.max:>10}")
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+import argparse
+import csv
+import json
+import sqlite3
+from collections import OrderedDict
+import message_codecs as mc
+
+"""
+LoginResponse(): Pre-encoded MsgLoginResponse for one uid.
+json is the payload as sent through the terminal link, binary is the as_bytes() form.
+"""
+class LoginResponse():
+    __slots__ = ('valid', 'msg', 'json', 'binary')
+
+    def __init__(self, msg):
+        self.valid = msg.response
+        self.msg = msg
+        self.json = msg.as_json().encode()
+        self.binary = msg.as_bytes()
+
+"""
+UserStore(): User database kept in SQLite, keyed by uid.
+The users table uses the uid as INTEGER PRIMARY KEY, so lookups go straight through SQLite's rowid B-tree and
+the database scales to hundreds of thousands of users without loading them in memory.
+Login responses are built once per uid and kept in a LRU cache, so a repeated login is a dictionary lookup.
+Negative responses (users not in the database) aren't cached, so a user added to the database can log in right
+away.
+"""
+class UserStore():
+    CACHE_SIZE = 4096
+    INVALID_PROFILE = 255
+
+    def __init__(self, filename=':memory:', cache_size=CACHE_SIZE):
+        # The store may be built in a background thread (config reload) and used from the main one
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS users (uid INTEGER PRIMARY KEY, username TEXT NOT NULL, profile INTEGER NOT NULL)")
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+
+    """
+    Builds a store from the configuration. If 'userdb_file' is set, it's opened as the SQLite user database.
+    Otherwise the 'userdb' dictionary of the configuration file is loaded in an in-memory database.
+    """
+    @classmethod
+    def from_config(cls, cfg):
+        if 'userdb_file' in cfg:
+            return cls(cfg['userdb_file'])
+        store = cls()
+        store.import_users((int(uid), u['username'], u['profile']) for uid, u in cfg.get('userdb', {}).items())
+        return store
+
+    def import_users(self, users):
+        # users is an iterable of (uid, username, profile) tuples
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO users (uid, username, profile) VALUES (?, ?, ?)", users)
+        self._cache.clear()
+
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def lookup(self, uid):
+        # Returns (username, profile) or None if the user doesn't exist
+        return self._db.execute("SELECT username, profile FROM users WHERE uid = ?", (uid,)).fetchone()
+
+    def login_response(self, uid):
+        try:
+            response = self._cache[uid]
+        except KeyError:
+            pass
+        else:
+            self._cache.move_to_end(uid)
+            return response
+
+        user = self.lookup(uid)
+        if user is not None:
+            msg = mc.MsgLoginResponse({'response': True, 'uid': uid, 'username': user[0], 'profile': user[1]})
+        else:
+            msg = mc.MsgLoginResponse({'response': False, 'uid': uid, 'username': "", 'profile': self.INVALID_PROFILE})
+            return LoginResponse(msg)
+        response = self._cache[uid] = LoginResponse(msg)
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+        return response
+
+    def close(self):
+        self._db.close()
+
+"""
+Reads (uid, username, profile) tuples from a CSV file (with a uid,username,profile header) or from the 'userdb'
+section of a JSON configuration file.
+"""
+def read_users(filename):
+    if filename.endswith('.json'):
+        with open(filename) as fh:
+            userdb = json.load(fh)['userdb']
+        for uid, u in userdb.items():
+            yield int(uid), u['username'], int(u['profile'])
+    else:
+        with open(filename, newline='') as fh:
+            for row in csv.DictReader(fh):
+                yield int(row['uid']), row['username'], int(row['profile'])
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser(description="Import users into a SQLite user database")
+    p.add_argument('source', help="CSV file (uid,username,profile) or JSON configuration file")
+    p.add_argument('database', help="SQLite user database (created if it doesn't exist)")
+    args = p.parse_args()
+
+    store = UserStore(args.database)
+    store.import_users(read_users(args.source))
+    print(f"{len(store)} users in {args.database}")
+    store.close()
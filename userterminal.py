@@ -4,119 +4,300 @@ import message_codecs as mc
 import queue
 import json
 import multiprocessing as mp
+import signal
+import itertools
+import sys
+import logpipe
+from metrics import Metrics
+from tracing import Tracer
+from profiling import Profiler
+from framelog import FrameLog, DIR_IN, DIR_OUT, frame_ids
+from clock import WallClock
+from linkquality import LinkQuality
+from admission import Admission, CRITICAL, BULK
 
 LOOP_BACKOFF = 0.001
 BUFFER_SIZE = 8192
+STATS_INTERVAL = 1.0    # Seconds between metric snapshots sent to the manager
 
+"""
+Returns the error number of a BluetoothError.
+"""
+def bt_errno(e):
+    return eval(e.args[0])[0]
+
+"""
+Connection(): A connected terminal, with the frame being received from it and its token bucket (see admission.py).
+"""
+class Connection():
+    __slots__ = ('id', 'sock', 'addr', 'bucket', 'buf', 'rxstart', 'lastrx')
+
+    def __init__(self, conn_id, sock, addr, bucket):
+        self.id = conn_id
+        self.sock = sock
+        self.addr = addr
+        self.bucket = bucket
+        self.buf = bytearray()
+        self.rxstart = 0.0
+        self.lastrx = 0.0
+
+"""
+UserTerminal(): Process handling the Bluetooth connections with the terminals.
+It listens on cfg_bt 'port' (or on every port in 'ports') and accepts up to 'max_connections' terminals (1 by
+default). Inbound frames are decoded and passed to the manager queue along with their connection id ('conn');
+user_connected and user_disconnected frames tell the manager about connection changes. What gets to the manager
+queue, and in which order, is decided by admission control (cfg_admission, see admission.py).
+"""
 class UserTerminal(mp.Process):
     rx_timeout = 0.05
-    def _subproc(self, cfg_bt, my_q, mgr_q, log):
-        server = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
-        server.bind(('', cfg_bt['port']))
+    def _subproc(self, cfg_bt, cfg_trace, cfg_log, cfg_framelog, cfg_admission, profile_dir, clock, my_q, mgr_q, log_q, log_level):
+        # Log records are sent to the main process, which writes them from a single background thread
+        log = logpipe.attach(log_q, log_level, cfg_log)
+
+        # Exit through SystemExit on SIGTERM, so the profile still gets written when the process is terminated
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
-        server.listen(1)
-        server.setblocking(False)
+        profiler = Profiler('userterminal', profile_dir or '.')
+        if profile_dir is not None:
+            profiler.start()
+        framelog = FrameLog.from_config(cfg_framelog, clock)
+        try:
+            self._loop(cfg_bt, cfg_trace, cfg_admission, profiler, framelog, clock, my_q, mgr_q, log)
+        finally:
+            if framelog is not None:
+                framelog.close()
+            filename = profiler.stop()
+            if filename is not None:
+                log.info(f"UserTerminal profile written to {filename}")
+
+    def _loop(self, cfg_bt, cfg_trace, cfg_admission, profiler, framelog, clock, my_q, mgr_q, log):
+        # One listening socket per port. Every accepted client gets a connection id, which goes along with the
+        # frames it sends and selects where outbound messages go.
+        servers = []
+        for port in cfg_bt.get('ports', [cfg_bt.get('port')]):
+            server = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
+            server.bind(('', port))
+            server.listen(cfg_bt.get('max_connections', 1))
+            server.setblocking(False)
+            servers.append(server)
+        max_connections = cfg_bt.get('max_connections', 1)
 
         log.debug("Bluetooth listening for connection")
-        client = None
+        metrics = Metrics()
+        tracer = Tracer(cfg_trace)
+        link = LinkQuality()
+        admission = Admission(cfg_admission, mgr_q)
+        connections = {}
+        conn_ids = itertools.count()
+
+        # Ship a metrics snapshot to the manager every STATS_INTERVAL seconds
+        def send_stats():
+            metrics.gauge('connected', len(connections))
+            stats = metrics.snapshot()
+            stats['link'] = link.stats()
+            stats['admission'] = admission.stats()
+            mgr_q.put({
+                'type': 'user_stats',
+                'stats': stats
+            })
+            clock.call_later(STATS_INTERVAL, send_stats)
+        clock.call_later(STATS_INTERVAL, send_stats)
+
+        def disconnect(conn):
+            del connections[conn.id]
+            log.info(f"Bluetooth client {conn.addr} disconnected")
+            # Lowest priority, so it reaches the manager after every frame admitted from the connection
+            admission.put(BULK, {'type': 'user_disconnected', 'conn': conn.id}, clock.monotonic())
+
         while True:
             do_loop_delay = True    # Used to determine if I put a delay at the end of the loop.
 
-            if client is None:
-                # Check if there's a connection request from a client
+            # Check if there are connection requests from clients
+            for server in servers:
+                if len(connections) >= max_connections:
+                    break
                 try:
                     client, clientaddr = server.accept()
                 except bluetooth.btcommon.BluetoothError as e:
-                    errno = eval(e.args[0])[0]
-                    if errno != 11:
+                    if bt_errno(e) != 11:
                         raise e
                 else:
                     if client is not None:
                         client.setblocking(False)
-                        log.info(f"Bluetooth client {clientaddr} connected")
+                        conn = Connection(next(conn_ids), client, clientaddr, admission.bucket(clock.monotonic()))
+                        connections[conn.id] = conn
+                        log.info(f"Bluetooth client {clientaddr} connected (connection {conn.id})")
+                        # Highest priority, so it reaches the manager before any frame from the connection
+                        admission.put(CRITICAL, {'type': 'user_connected', 'conn': conn.id}, clock.monotonic())
 
-            if client is not None:
-                # Check if there's data in the input buffer, if not, skip the reading
+            for conn in list(connections.values()):
+                # Check if there's data in the input buffer
                 try:
-                    pkt = client.recv(BUFFER_SIZE)
+                    data = conn.sock.recv(BUFFER_SIZE)
                 except bluetooth.btcommon.BluetoothError as e:
-                    errno = eval(e.args[0])[0]
-                    if errno != 11:
-                        # client got disconnected
-                        client = None
+                    if bt_errno(e) != 11:
+                        # Any errno other than 11 (Resource unavailable) is considered as a client disconnection.
+                        disconnect(conn)
+                        continue
                 else:
-                    # If there was data in the input buffer, keep reading until the packet data gets tranferred completely.
-                    # The packet is considered finished when I don't receive any data for self.rx_timeout seconds.
-                    lastrxtime = time.time()
-                    while time.time() - lastrxtime < self.rx_timeout:
-                        try:
-                            pkt += client.recv(BUFFER_SIZE)
-                        except bluetooth.btcommon.BluetoothError as e:
-                            errno = eval(e.args[0])[0]
-                            if errno != 11:
-                                # Any errno other than 11 (Resource unavailable) is considered as a client disconnection.
-                                client = None
-                                break
-                            else:
-                                time.sleep(LOOP_BACKOFF)
-                        else:
-                            lastrxtime = time.time()
-                    else:
-                        # If the while loop finishes normally (by timeout), it means we have an input packet
-                        do_loop_delay = False
-                        try:
-                            msg = mc.parse_json(pkt)
-                        except json.decoder.JSONDecodeError as e:
-                            mgr_q.put({
-                                'type': 'user_received_malformed',
-                                'msg': pkt,
-                                'error': str(e)
-                            })
-                        except KeyError as e:
-                            mgr_q.put({
-                                'type': 'user_received_malformed',
-                                'msg': pkt,
-                                'error': f"Message key {str(e)} missing"
-                            })
-                        except Exception as e:
-                            self.log.error(f"Exception raised: {e.args}")
-                        else:
-                            mgr_q.put({
-                                'type': 'user_received',
-                                'msg': msg
-                            })
+                    if not conn.buf:
+                        conn.rxstart = clock.monotonic()
+                    conn.buf += data
+                    conn.lastrx = clock.monotonic()
+                    continue
+
+                # The packet is considered finished when no data is received for self.rx_timeout seconds
+                if not conn.buf or clock.monotonic() - conn.lastrx < self.rx_timeout:
+                    continue
+                pkt = bytes(conn.buf)
+                conn.buf.clear()
+                do_loop_delay = False
+                trace_id = tracer.sample()
+                if trace_id is not None:
+                    trace = {'id': trace_id, 'stages': {'recv_start': conn.rxstart, 'recv_complete': clock.monotonic()}}
+                else:
+                    trace = None
+                t0 = time.perf_counter_ns()
+                # Every frame is logged as received, before it can be dropped as a duplicate, shed or found malformed
+                if framelog is not None:
+                    log_frame = lambda value: framelog.append(pkt, *frame_ids(value), DIR_IN, conn=conn.id)
+                else:
+                    log_frame = None
+                try:
+                    level, msg, error = admission.receive(pkt, link, conn.bucket, clock.monotonic(), log_frame)
+                except Exception as e:
+                    metrics.malformed += 1
+                    log.error(f"Exception raised: {e.args}")
+                    continue
+                if error is not None:
+                    metrics.malformed += 1
+                if level is None:
+                    continue
+                if msg is None:
+                    admission.put(level, {
+                        'type': 'user_received_malformed',
+                        'msg': pkt,
+                        'error': error,
+                        'conn': conn.id
+                    }, clock.monotonic())
+                else:
+                    metrics.inbound(msg.NAME, len(pkt), time.perf_counter_ns() - t0)
+                    if trace is not None:
+                        trace['name'] = msg.NAME
+                        trace['stages']['decode_done'] = clock.monotonic()
+                        trace['stages']['enqueue'] = clock.monotonic()
+                    admission.put(level, {
+                        'type': 'user_received',
+                        'msg': msg,
+                        'trace': trace,
+                        'conn': conn.id
+                    }, clock.monotonic())
+
+            # Let the frames waiting in admission control into the manager queue, as far as there's room
+            if admission.forward(clock.monotonic()):
+                do_loop_delay = False
 
             # Check if there's a message in the outbound queue
             try:
-                msg = my_q.get_nowait()
+                obj = my_q.get_nowait()
             except queue.Empty:
                 pass
             else:
-                msg_sent = False
+                if obj['type'] == 'stop':
+                    log.debug("UserTerminal stopping")
+                    break
 
-                # If a message needs to be sent, check if the client is connected
-                if client is not None:
-                    do_loop_delay = False
+                elif obj['type'] == 'profile':
+                    if obj['action'] == 'start':
+                        profiler.start()
+                    else:
+                        mgr_q.put({
+                            'type': 'user_profile',
+                            'file': profiler.stop()
+                        })
 
-                    try:
-                        client.send(msg.as_json())
-                    except bluetooth.btcommon.BluetoothError as e:
-                        log.warning(f"Error sending message to remote device: {str(e)}")
+                else:
+                    msg = obj['msg']
+                    msg_sent = False
+
+                    # Messages go to one connection, or to all of them if none is given
+                    if obj.get('conn') is None:
+                        targets = list(connections.values())
                     else:
-                        msg_sent = True
+                        targets = [connections[obj['conn']]] if obj['conn'] in connections else []
+
+                    if targets:
+                        do_loop_delay = False
 
-                if not msg_sent:
-                    mgr_q.put({
-                        'type': 'user_undelivered',
-                        'msg': msg
-                    })
+                        # Messages may come already encoded (bytes) or as message objects
+                        t0 = time.perf_counter_ns()
+                        data = msg if isinstance(msg, bytes) else msg.as_json().encode()
+                        encode_ns = time.perf_counter_ns() - t0
+                        for conn in targets:
+                            try:
+                                conn.sock.send(data)
+                            except bluetooth.btcommon.BluetoothError as e:
+                                log.warning(f"Error sending message to remote device: {str(e)}")
+                            else:
+                                msg_sent = True
+                                metrics.outbound(obj['name'], len(data), encode_ns)
+                                if framelog is not None and framelog.capture:
+                                    framelog.append(data, 0, mc.MSG_TYPES.get(obj['name'], 0), DIR_OUT, conn=conn.id)
+                        if msg_sent and obj['trace'] is not None:
+                            obj['trace']['stages']['socket_write'] = clock.monotonic()
+                            tracer.write(obj['trace'])
+
+                    if not msg_sent:
+                        mgr_q.put({
+                            'type': 'user_undelivered',
+                            'msg': msg,
+                            'conn': obj.get('conn')
+                        })
+
+            clock.run_due()
 
             if do_loop_delay:
-                time.sleep(LOOP_BACKOFF)
-            
-    def __init__(self, cfg_bt, mgr_q, log):
+                clock.sleep(LOOP_BACKOFF)
+
+    """
+    clock is the clock the process uses for timeouts, delays and timestamps (see clock.py), WallClock by default.
+    cfg_admission is the 'admission' configuration section (see admission.Admission).
+    """
+    def __init__(self, cfg_bt, mgr_q, log_q, log_level, cfg_trace=None, cfg_log=None, profile_dir=None, cfg_framelog=None, clock=None, cfg_admission=None):
         self._proc_q = mp.Queue()
-        self.send = self._proc_q.put
-        self.log = log
-        super().__init__(target=self._subproc, args=(cfg_bt, self._proc_q, mgr_q, log))
+        super().__init__(target=self._subproc, args=(cfg_bt, cfg_trace, cfg_log, cfg_framelog, cfg_admission, profile_dir, clock or WallClock(), self._proc_q, mgr_q, log_q, log_level))
         super().start()
+
+    """
+    Queues a message to be sent to the terminal. msg can be a message object or an already encoded payload (bytes).
+    trace is the outbound trace record, if the message is part of a sampled trace. name is the message type name
+    used in metrics, needed for pre-encoded payloads. conn is the connection id to send it to, None sends it to
+    every connected terminal.
+    """
+    def send(self, msg, trace=None, name=None, conn=None):
+        self._proc_q.put({
+            'type': 'send',
+            'msg': msg,
+            'trace': trace,
+            'name': name or getattr(msg, 'NAME', 'raw'),
+            'conn': conn
+        })
+
+    """
+    Starts (action='start') or stops (action='stop') a profiling window in the UserTerminal process.
+    When stopped, the profile file name is reported back through the manager queue.
+    """
+    def profile(self, action):
+        self._proc_q.put({
+            'type': 'profile',
+            'action': action
+        })
+
+    """
+    Asks the UserTerminal process to finish and waits for it. It's terminated if it doesn't finish in time.
+    """
+    def stop(self, timeout=2):
+        self._proc_q.put({'type': 'stop'})
+        self.join(timeout)
+        if self.is_alive():
+            self.terminate()